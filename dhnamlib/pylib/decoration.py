@@ -1,12 +1,50 @@
 
+import os
+import sys
 import functools
 import inspect
+import types
 import itertools
 import warnings
+import hashlib
+import pickle
+import sqlite3
+import asyncio
+import concurrent.futures
+import threading
+import weakref
+from collections import OrderedDict
 from contextlib import ContextDecorator
 
 from . import filesys
 from .constant import NO_VALUE
+from .time import TimeMeasure
+
+
+def _analyze_curry_signature(func):
+    signature = inspect.signature(func)
+    position_to_param_key = []
+    non_default_param_keys = set()
+    reading_positional_params = True
+    num_positional_only_params = 0
+    for name, param in signature.parameters.items():
+        if param.default is not inspect._empty:
+            reading_positional_params = False
+        else:
+            non_default_param_keys.add(name)
+            if param.kind is inspect._ParameterKind.KEYWORD_ONLY:
+                reading_positional_params = False
+            else:
+                assert reading_positional_params
+                # *args, **kwargs are disallowed
+                # assert param.kind not in {inspect._ParameterKind.VAR_POSITIONAL, inspect._ParameterKind.VAR_KEYWORD}
+                if param.kind is inspect._ParameterKind.POSITIONAL_ONLY:
+                    num_positional_only_params += 1
+                else:
+                    param.kind is inspect._ParameterKind.POSITIONAL_OR_KEYWORD
+                position_to_param_key.append(name)
+
+    return position_to_param_key, non_default_param_keys, num_positional_only_params
 
 
 def curry(func, *args, **kwargs):
@@ -34,27 +72,7 @@ def curry(func, *args, **kwargs):
     # >>> partial(partial(partial(f, 1,2, a=10), 3,4, b=20), 5,6, c=30)()
     # ((1, 2, 3, 4, 5, 6), {'a': 10, 'b': 20, 'c': 30})
 
-    signature = inspect.signature(func)
-    position_to_param_key = []
-    non_default_param_keys = set()
-    reading_positional_params = True
-    num_positional_only_params = 0
-    for name, param in signature.parameters.items():
-        if param.default is not inspect._empty:
-            reading_positional_params = False
-        else:
-            non_default_param_keys.add(name)
-            if param.kind is inspect._ParameterKind.KEYWORD_ONLY:
-                reading_positional_params = False
-            else:
-                assert reading_positional_params
-                # *args, **kwargs are disallowed
-                # assert param.kind not in {inspect._ParameterKind.VAR_POSITIONAL, inspect._ParameterKind.VAR_KEYWORD}
-                if param.kind is inspect._ParameterKind.POSITIONAL_ONLY:
-                    num_positional_only_params += 1
-                else:
-                    param.kind is inspect._ParameterKind.POSITIONAL_OR_KEYWORD
-                position_to_param_key.append(name)
+    position_to_param_key, non_default_param_keys, num_positional_only_params = _analyze_curry_signature(func)
 
     def make_curried(prev_args, prev_kwargs):
         @functools.wraps(func)
@@ -86,6 +104,139 @@ def curry(func, *args, **kwargs):
     return make_curried(args, kwargs)
 
 
+class _CompiledCurry:
+    """
+    A curried function whose signature is analyzed once.
+    Completion of each number of positional arguments is precomputed,
+    so a complete call is dispatched to the function after a few checks.
+    """
+
+    def __init__(self, func):
+        position_to_param_key, non_default_param_keys, num_positional_only_params = _analyze_curry_signature(func)
+        self.func = func
+        self.position_to_param_key = tuple(position_to_param_key)
+        self.num_positional_params = len(position_to_param_key)
+        self.num_positional_only_params = num_positional_only_params
+        # remaining_param_keys[n] is the set of required parameters which are not filled by n positional arguments
+        self.remaining_param_keys = tuple(
+            frozenset(non_default_param_keys.difference(position_to_param_key[:num_args]))
+            for num_args in range(len(position_to_param_key) + 1))
+        functools.update_wrapper(self, func)
+
+    def apply(self, args, kwargs):
+        num_args = len(args)
+        assert num_args <= self.num_positional_params
+        if num_args >= self.num_positional_only_params and self.remaining_param_keys[num_args].issubset(kwargs):
+            return self.func(*args, **kwargs)
+        else:
+            return _CurriedPartial(self, args, kwargs)
+
+    def __call__(self, *args, **kwargs):
+        return self.apply(args, kwargs)
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        else:
+            return types.MethodType(self, obj)
+
+    def __repr__(self):
+        return f'<compiled curry of {self.func!r}>'
+
+
+class _CurriedPartial:
+    __slots__ = ('curried', 'args', 'kwargs')
+
+    def __init__(self, curried, args, kwargs):
+        self.curried = curried
+        self.args = args
+        self.kwargs = kwargs
+
+    def __call__(self, *args, **kwargs):
+        curried = self.curried
+        if args:
+            new_args = self.args + args
+            assert all(param_key not in self.kwargs
+                       for param_key in curried.position_to_param_key[len(self.args):len(new_args)])
+        else:
+            new_args = self.args
+        if kwargs:
+            assert self.kwargs.keys().isdisjoint(kwargs)
+            new_kwargs = dict(self.kwargs)
+            new_kwargs.update(kwargs)
+        else:
+            new_kwargs = self.kwargs
+        return curried.apply(new_args, new_kwargs)
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        else:
+            return types.MethodType(self, obj)
+
+    @property
+    def __wrapped__(self):
+        return self.curried.func
+
+    def __repr__(self):
+        return f'<curried partial of {self.curried.func!r} with args={self.args!r}, kwargs={self.kwargs!r}>'
+
+
+def compiled_curry(func, *args, **kwargs):
+    '''
+    Same as `curry`, but the signature of `func` is analyzed once and
+    partial applications are lightweight objects rather than nested closures.
+    It's suitable for functions that are called frequently.
+
+    Example
+    >>> @compiled_curry
+    ... def func(a, b, c, *, d, e, f=6, g=7):
+    ...     return (a, b, c, d, e, f, g)
+    >>>
+    >>> print(func(1, 2, 3)(d=4, e=5))
+    (1, 2, 3, 4, 5, 6, 7)
+    >>> print(func(1, 2)(3)(d=4, e=5))
+    (1, 2, 3, 4, 5, 6, 7)
+    >>> print(func(1, 2, d=4)(3, e=5))
+    (1, 2, 3, 4, 5, 6, 7)
+    >>> print(func(1, 2, d=4)(3, e=5, f=66))
+    (1, 2, 3, 4, 5, 66, 7)
+    >>> print(func(1, 2, 3, d=4, e=5))
+    (1, 2, 3, 4, 5, 6, 7)
+    '''
+
+    curried = _CompiledCurry(func)
+    if args or kwargs:
+        return curried.apply(args, kwargs)
+    else:
+        return curried
+
+
+def benchmark_curry(num_calls=100000):
+    """
+    Measure the overhead per call of `curry` and `compiled_curry` compared to a direct call.
+    """
+
+    def func(a, b, *, c, d=4):
+        return a
+
+    curried = curry(func)
+    compiled = compiled_curry(func)
+
+    def measure(call):
+        with TimeMeasure() as tm:
+            for _ in range(num_calls):
+                call()
+        return tm.interval / num_calls
+
+    direct_time = measure(lambda: func(1, 2, c=3))
+    for name, curried_func in [('curry', curried), ('compiled_curry', compiled)]:
+        complete_time = measure(lambda: curried_func(1, 2, c=3))
+        partial_time = measure(lambda: curried_func(1)(2)(c=3))
+        print(f'{name}: complete call overhead = {(complete_time - direct_time) * 1e6:.3f}us, '
+              f'three-step call overhead = {(partial_time - direct_time) * 1e6:.3f}us')
+
+
 # def _cache(func):
 #     """keep a cache of previous function calls.
 #     it's similar to functools.lru_cache"""
@@ -104,7 +255,7 @@ def curry(func, *args, **kwargs):
 #     return cached_func
 
 
-@curry
+@compiled_curry
 def cache(func, maxsize=None):
     return functools.lru_cache(maxsize)(func)
 
@@ -113,19 +264,126 @@ def cached_property(func):
     return property(cache(func))
 
 
-def id_cache(func):
+def _is_weakrefable(obj):
+    try:
+        weakref.ref(obj)
+    except TypeError:
+        return False
+    else:
+        return True
+
+
+def _is_hashable(obj):
+    try:
+        hash(obj)
+    except TypeError:
+        return False
+    else:
+        return True
+
+
+@compiled_curry
+def id_cache(func, maxsize=128):
     """
     Keep a cache of previous function calls.
     It uses IDs of arguments for computing keys.
+
+    An entry is evicted when any of its arguments is garbage-collected, so the ID of a dead object
+    cannot produce a wrong hit when it's reused by a new object.
+    Arguments that are not weak-referenceable but hashable (e.g. int, str, tuple) are keyed by their values instead,
+    and the other arguments (e.g. list, dict) are kept alive by their entries.
+    When the cache has more than `maxsize` entries, the least recently used entries are evicted.
+    `maxsize=None` makes the cache unbounded.
+
+    Note that an entry whose result refers to its arguments keeps them alive until the entry is evicted.
+
+    >>> class Obj:
+    ...     pass
+    >>> @id_cache
+    ... def describe(obj, num):
+    ...     print('describe is called')
+    ...     return f'{type(obj).__name__}-{num}'
+    >>> obj = Obj()
+    >>> describe(obj, 1)
+    describe is called
+    'Obj-1'
+    >>> describe(obj, 1)
+    'Obj-1'
+    >>> len(describe.cache)
+    1
+    >>> del obj
+    >>> len(describe.cache)
+    0
+    >>> describe('obj', 1)
+    describe is called
+    'str-1'
+    >>> describe('o' + 'bj', 1)
+    'str-1'
+    >>> @id_cache
+    ... def pair(x, y):
+    ...     return (x, y)
+    >>> for num in range(1000):
+    ...     _ = pair(num * 1000003, 'k' * 3)
+    >>> len(pair.cache)
+    128
     """
 
-    def key(*args, **kwargs):
-        return tuple(itertools.chain(map(id, args), sorted((k, id(v)) for k, v in kwargs.items())))
+    # key -> (result, finalizers, strong_refs)
+    cache_memory = OrderedDict()
 
-    return keyed_cache(key, func)
+    def get_arg_key(arg):
+        if _is_weakrefable(arg) or not _is_hashable(arg):
+            return id(arg)
+        else:
+            # The type distinguishes equal values such as 1, 1.0 and True
+            return (type(arg), arg)
 
+    def evict(cache_key):
+        entry = cache_memory.pop(cache_key, None)
+        if entry is not None:
+            result, finalizers, strong_refs = entry
+            for finalizer in finalizers:
+                finalizer.detach()
 
-@curry
+    @functools.wraps(func)
+    def cached_func(*args, **kwargs):
+        sorted_kwarg_items = sorted(kwargs.items())
+        cache_key = tuple(itertools.chain(map(get_arg_key, args), ((k, get_arg_key(v)) for k, v in sorted_kwarg_items)))
+        entry = cache_memory.get(cache_key)
+        if entry is not None:
+            if maxsize is not None:
+                cache_memory.move_to_end(cache_key)
+            return entry[0]
+
+        result = func(*args, **kwargs)
+
+        finalizers = []
+        strong_refs = []
+        for arg in itertools.chain(args, (v for k, v in sorted_kwarg_items)):
+            if _is_weakrefable(arg):
+                finalizers.append(weakref.finalize(arg, evict, cache_key))
+            elif not _is_hashable(arg):
+                strong_refs.append(arg)
+        for finalizer in finalizers:
+            # Finalizers don't need to be called at exit
+            finalizer.atexit = False
+
+        cache_memory[cache_key] = (result, finalizers, strong_refs)
+        if maxsize is not None and len(cache_memory) > maxsize:
+            evict(next(iter(cache_memory)))
+        return result
+
+    def cache_clear():
+        for cache_key in tuple(cache_memory):
+            evict(cache_key)
+
+    cached_func.cache = cache_memory
+    cached_func.cache_clear = cache_clear
+
+    return cached_func
+
+
+@compiled_curry
 def keyed_cache(key, func):
     """
     Cache with a custom key function.
@@ -233,14 +491,114 @@ save_load_pair_dict = dict(
     json_pretty=(filesys.json_pretty_save, filesys.json_load),
     extended_json=(filesys.extended_json_save, filesys.extended_json_load),
     extended_json_pretty=(filesys.extended_json_pretty_save, filesys.extended_json_load),
+    extended_msgpack=(filesys.extended_msgpack_save, filesys.extended_msgpack_load),
 )
 
 
 FILE_CACHE_DEFAULT_FORMAT = 'extended_json_pretty'
+FILE_CACHE_DEFAULT_MEMORY_SIZE = 128
 
 
-def file_cache(file_path_arg_name='file_cache_path', *, save_fn=None, load_fn=None, format=None):
+class _FileCacheMemory:
+    """
+    The in-memory layer of a file cache, which keeps the most recently used objects with
+    the modification times of their files.
+    """
+
+    def __init__(self, maxsize):
+        assert maxsize > 0
+        self.maxsize = maxsize
+        self.entries = OrderedDict()  # file path -> (mtime, object)
+
+    def get(self, file_path, mtime):
+        entry = self.entries.get(file_path)
+        if entry is not None and entry[0] == mtime:
+            self.entries.move_to_end(file_path)
+            return entry[1]
+        else:
+            return NO_VALUE
+
+    def set(self, file_path, mtime, obj):
+        self.entries[file_path] = (mtime, obj)
+        self.entries.move_to_end(file_path)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def discard(self, file_path):
+        self.entries.pop(file_path, None)
+
+    def discard_missing(self):
+        for file_path in tuple(self.entries):
+            if not os.path.isfile(file_path):
+                del self.entries[file_path]
+
+
+def _make_file_cache_memory(memory_caching):
+    if not memory_caching:
+        return None
+    else:
+        return _FileCacheMemory(FILE_CACHE_DEFAULT_MEMORY_SIZE if memory_caching is True else memory_caching)
+
+
+def _load_or_compute(file_path, compute_fn, save_fn, load_fn, locking, memory):
+    """
+    :returns: a pair of the object and a boolean value that indicates whether the object is computed
+    """
+
+    if memory is not None:
+        try:
+            mtime = os.stat(file_path).st_mtime_ns
+        except FileNotFoundError:
+            memory.discard(file_path)
+        else:
+            obj = memory.get(file_path, mtime)
+            if obj is not NO_VALUE:
+                return obj, False
+
+    def load_if_exist():
+        try:
+            return load_fn(file_path)
+        except FileNotFoundError:
+            # The file doesn't exist or it's removed by another process
+            return NO_VALUE
+
+    def compute_and_save():
+        obj = compute_fn()
+        filesys.mkpdirs_unless_exist(file_path)
+        # `save_fn` of `save_load_pair_dict` writes a file atomically
+        save_fn(obj, file_path)
+        return obj
+
+    computed = False
+    obj = load_if_exist()
+    if obj is NO_VALUE:
+        if locking:
+            filesys.mkpdirs_unless_exist(file_path)
+            with filesys.file_lock(file_path):
+                # Another process may have computed the object while waiting for the lock
+                obj = load_if_exist()
+                if obj is NO_VALUE:
+                    obj = compute_and_save()
+                    computed = True
+        else:
+            obj = compute_and_save()
+            computed = True
+
+    if memory is not None:
+        memory.set(file_path, os.stat(file_path).st_mtime_ns, obj)
+
+    return obj, computed
+
+
+def file_cache(file_path_arg_name='file_cache_path', *, save_fn=None, load_fn=None, format=None,
+               locking=False, memory_caching=False):
     '''
+    :param locking: If True, a per-path inter-process lock is used, so only one process computes an object while
+        the other processes wait and then load the saved object.
+    :param memory_caching: If True, loaded objects are also kept in memory and returned without deserialization
+        while their files are unchanged. Only the `FILE_CACHE_DEFAULT_MEMORY_SIZE` most recently used objects are kept,
+        and `memory_caching` can also be the number of objects to keep.
+
     Example 1
     >>> from dhnamlib.pylib.filesys import json_save, json_load
     >>> from dhnamlib.pylib.decoration import file_cache
@@ -273,18 +631,16 @@ def file_cache(file_path_arg_name='file_cache_path', *, save_fn=None, load_fn=No
         save_fn, load_fn = save_load_pair_dict[format]
 
     def file_cache_decorator(func):
+        memory = _make_file_cache_memory(memory_caching)
+
         @functools.wraps(func)
         def file_cache_func(*args, **kwargs):
             file_path = kwargs.get(file_path_arg_name)
             assert file_path is not None, f'\'{file_path_arg_name}\' is not designated'
             del kwargs[file_path_arg_name]
 
-            if os.path.isfile(file_path):
-                obj = load_fn(file_path)
-            else:
-                obj = func(*args, **kwargs)
-                filesys.mkpdirs_unless_exist(file_path)
-                save_fn(obj, file_path)
+            obj, _ = _load_or_compute(
+                file_path, lambda: func(*args, **kwargs), save_fn, load_fn, locking, memory)
             return obj
 
         return file_cache_func
@@ -295,6 +651,540 @@ def file_cache(file_path_arg_name='file_cache_path', *, save_fn=None, load_fn=No
 fcache = file_cache(format=FILE_CACHE_DEFAULT_FORMAT)
 
 
+format_extension_dict = dict(
+    pickle='.pkl',
+    json='.json',
+    json_pretty='.json',
+    extended_json='.json',
+    extended_json_pretty='.json',
+    extended_msgpack='.msgpack',
+)
+
+
+def _update_hasher(hasher, obj):
+    # Objects are encoded in a canonical way, so equal arguments have the same hash across processes.
+    # (e.g. the iteration order of a set of strings depends on the hash seed of a process)
+    hasher.update(type(obj).__qualname__.encode('utf-8'))
+    if obj is None or isinstance(obj, (bool, int, float, complex, str, bytes)):
+        hasher.update(repr(obj).encode('utf-8'))
+    elif isinstance(obj, (list, tuple)):
+        hasher.update(b'[')
+        for elem in obj:
+            _update_hasher(hasher, elem)
+        hasher.update(b']')
+    elif isinstance(obj, (set, frozenset, dict)):
+        items = obj.items() if isinstance(obj, dict) else obj
+        hasher.update(b'{')
+        for digest in sorted(_get_digest(item) for item in items):
+            hasher.update(digest)
+        hasher.update(b'}')
+    else:
+        hasher.update(pickle.dumps(obj, protocol=4))
+
+
+def _get_digest(obj):
+    hasher = hashlib.sha256()
+    _update_hasher(hasher, obj)
+    return hasher.digest()
+
+
+def _get_func_source(func):
+    try:
+        return inspect.getsource(func)
+    except (OSError, TypeError):
+        # The source is not available (e.g. a function defined in an interactive session)
+        code = func.__code__
+        return repr((code.co_code, code.co_consts, code.co_names))
+
+
+class FileCacheStats:
+    def __init__(self):
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_evictions = 0
+        self.load_time = 0.0
+        self.compute_time = 0.0
+
+    def __repr__(self):
+        return ('FileCacheStats(num_hits={}, num_misses={}, num_evictions={}, load_time={:.3f}s, compute_time={:.3f}s)'
+                .format(self.num_hits, self.num_misses, self.num_evictions, self.load_time, self.compute_time))
+
+
+def evict_cache_files(dir_path, max_size=None, max_age=None):
+    '''
+    Remove files in a directory whose ages exceed `max_age` seconds, then
+    remove the least recently used files until the total size doesn't exceed `max_size` bytes.
+    The modification time of a file is regarded as its last use.
+
+    The lock file of a removed file (see `filesys.file_lock`) is also removed unless the lock is held,
+    as well as lock files of files that no longer exist.
+
+    :returns: the number of removed files
+    '''
+    import time
+
+    if not os.path.isdir(dir_path):
+        return 0
+
+    entries = []
+    locked_paths = []
+    for dir_entry in os.scandir(dir_path):
+        if dir_entry.is_file():
+            if not dir_entry.name.startswith('.'):
+                stat = dir_entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, dir_entry.path))
+            elif dir_entry.name.endswith('.lock'):
+                locked_paths.append(os.path.join(dir_path, dir_entry.name[1:-len('.lock')]))
+    entries.sort()
+
+    removed_paths = []
+    if max_age is not None:
+        min_mtime = time.time() - max_age
+        removed_paths.extend(path for mtime, size, path in entries if mtime < min_mtime)
+        entries = [entry for entry in entries if entry[0] >= min_mtime]
+    if max_size is not None:
+        total_size = sum(size for mtime, size, path in entries)
+        for mtime, size, path in entries:
+            if total_size <= max_size:
+                break
+            removed_paths.append(path)
+            total_size -= size
+
+    for path in removed_paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # Another process may have removed the file
+            pass
+
+    for path in locked_paths:
+        if not os.path.exists(path):
+            filesys.remove_lock_file(path)
+
+    return len(removed_paths)
+
+
+def get_default_file_cache_dir():
+    return os.environ.get(
+        'DHNAMLIB_FILE_CACHE_DIR',
+        os.path.join(os.path.expanduser('~'), '.cache', 'dhnamlib', 'file_cache'))
+
+
+def hashed_file_cache(cache_dir=None, *, version=None, format=None, save_fn=None, load_fn=None, extension=None,
+                      max_size=None, max_age=None, locking=False, memory_caching=False):
+    '''
+    File cache whose path is derived from a stable hash of the function source, the arguments and `version`.
+    When the function's code or the arguments change, the cache path changes, so a stale result is not loaded.
+
+    :param cache_dir: The directory where the cache files of functions are saved.
+        When `cache_dir` is None, `$DHNAMLIB_FILE_CACHE_DIR` or `~/.cache/dhnamlib/file_cache` is used.
+    :param version: A tag that is mixed into the hash. Change it to invalidate old cache files.
+    :param max_size: The maximum total size (bytes) of the cache files of the function.
+    :param max_age: The maximum age (seconds) of the cache files of the function.
+    :param locking: See `file_cache`.
+    :param memory_caching: See `file_cache`.
+
+    The decorated function has the following attributes:
+
+    - `cache_stats`: a `FileCacheStats` object which counts hits, misses and evictions, and measures time.
+    - `get_cache_path(*args, **kwargs)`: the path of the cache file for the arguments
+    - `print_cache_stats()`
+
+    Example:
+
+    >>> import tempfile, shutil
+    >>> cache_dir = tempfile.mkdtemp()
+    >>> @hashed_file_cache(cache_dir, format='json')
+    ... def make_dict_and_print(*pairs):
+    ...     d = dict(pairs)
+    ...     print('make_dict_and_print is called')
+    ...     return d
+    >>> make_dict_and_print(['a', 2], ['b', 4])
+    make_dict_and_print is called
+    {'a': 2, 'b': 4}
+    >>> make_dict_and_print(['a', 2], ['b', 4])
+    {'a': 2, 'b': 4}
+    >>> make_dict_and_print.cache_stats.num_hits, make_dict_and_print.cache_stats.num_misses
+    (1, 1)
+    >>> shutil.rmtree(cache_dir)
+    '''
+
+    if cache_dir is None:
+        cache_dir = get_default_file_cache_dir()
+
+    if format is save_fn is load_fn is None:
+        format = FILE_CACHE_DEFAULT_FORMAT
+
+    if format is not None:
+        assert save_fn is load_fn is None
+        save_fn, load_fn = save_load_pair_dict[format]
+        if extension is None:
+            extension = format_extension_dict[format]
+
+    if extension is None:
+        extension = ''
+
+    def file_cache_decorator(func):
+        func_dir_path = os.path.join(cache_dir, f'{func.__module__}.{func.__qualname__}')
+        func_digest = None
+        stats = FileCacheStats()
+        memory = _make_file_cache_memory(memory_caching)
+
+        def get_cache_path(*args, **kwargs):
+            nonlocal func_digest
+            if func_digest is None:
+                func_digest = _get_digest((_get_func_source(func), version))
+            hasher = hashlib.sha256(func_digest)
+            _update_hasher(hasher, (args, kwargs))
+            return os.path.join(func_dir_path, hasher.hexdigest() + extension)
+
+        @functools.wraps(func)
+        def file_cache_func(*args, **kwargs):
+            file_path = get_cache_path(*args, **kwargs)
+
+            with TimeMeasure() as tm:
+                obj, computed = _load_or_compute(
+                    file_path, lambda: func(*args, **kwargs), save_fn, load_fn, locking, memory)
+
+            if computed:
+                stats.num_misses += 1
+                stats.compute_time += tm.interval
+                if max_size is not None or max_age is not None:
+                    stats.num_evictions += evict_cache_files(func_dir_path, max_size=max_size, max_age=max_age)
+                    if memory is not None:
+                        memory.discard_missing()
+            else:
+                stats.num_hits += 1
+                stats.load_time += tm.interval
+                if max_size is not None and os.path.isfile(file_path):
+                    # Update the modification time for eviction of the least recently used files
+                    os.utime(file_path)
+                    if memory is not None:
+                        memory.set(file_path, os.stat(file_path).st_mtime_ns, obj)
+            return obj
+
+        def print_cache_stats():
+            print(f'{func.__qualname__}: {stats}')
+
+        file_cache_func.cache_stats = stats
+        file_cache_func.get_cache_path = get_cache_path
+        file_cache_func.print_cache_stats = print_cache_stats
+
+        return file_cache_func
+
+    return file_cache_decorator
+
+
+class TieredCacheStats:
+    def __init__(self):
+        self.num_memory_hits = 0
+        self.num_disk_hits = 0
+        self.num_misses = 0
+        self.num_evictions = 0
+
+    @property
+    def num_hits(self):
+        return self.num_memory_hits + self.num_disk_hits
+
+    def __repr__(self):
+        return ('TieredCacheStats(num_memory_hits={}, num_disk_hits={}, num_misses={}, num_evictions={})'
+                .format(self.num_memory_hits, self.num_disk_hits, self.num_misses, self.num_evictions))
+
+
+class _SqliteCacheStore:
+    '''
+    A table of pickled values which is shared by functions and processes.
+    A connection is opened lazily for each process, since a sqlite connection cannot be used after fork.
+    '''
+
+    def __init__(self, db_path, func_name):
+        self.db_path = db_path
+        self.func_name = func_name
+        self._connection = None
+        self._pid = None
+
+    @property
+    def connection(self):
+        if self._connection is None or self._pid != os.getpid():
+            filesys.mkpdirs_unless_exist(self.db_path)
+            self._connection = sqlite3.connect(self.db_path, timeout=60, check_same_thread=False)
+            self._connection.execute('CREATE TABLE IF NOT EXISTS tiered_cache '
+                                     '(func TEXT, key BLOB, value BLOB, PRIMARY KEY (func, key))')
+            self._connection.commit()
+            self._pid = os.getpid()
+        return self._connection
+
+    def get(self, key_digest):
+        row = self.connection.execute('SELECT value FROM tiered_cache WHERE func = ? AND key = ?',
+                                      (self.func_name, key_digest)).fetchone()
+        return NO_VALUE if row is None else pickle.loads(row[0])
+
+    def put(self, key_digest, value):
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO tiered_cache VALUES (?, ?, ?)',
+                                    (self.func_name, key_digest, pickle.dumps(value, protocol=4)))
+
+    def clear(self):
+        with self.connection:
+            self.connection.execute('DELETE FROM tiered_cache WHERE func = ?', (self.func_name,))
+
+
+def _default_cache_key(*args, **kwargs):
+    return (args, tuple(sorted(kwargs.items())))
+
+
+def tiered_cache(db_path=None, *, maxsize=128, max_cost=None, cost_fn=None, key=None):
+    '''
+    Cache with a bounded in-memory LRU layer in front of a SQLite disk layer.
+    Computed values are written to both layers. When the memory layer exceeds its bounds,
+    the least recently used values are evicted from memory but they remain on disk.
+
+    :param db_path: The path of a SQLite database file. When `db_path` is None, only the memory layer is used.
+    :param maxsize: The maximum number of values in memory. None means no limit.
+    :param max_cost: The maximum total cost of values in memory. None means no limit.
+    :param cost_fn: A function that computes the cost of a value. The default is `sys.getsizeof`.
+    :param key: A function that computes a hashable key from arguments.
+        The default key consists of the positional arguments and the sorted keyword arguments.
+
+    The decorated function has the following attributes:
+
+    - `cache_stats`: a `TieredCacheStats` object which counts hits, misses and evictions
+    - `cache_clear()`: remove the values of the function from both layers
+
+    Example:
+
+    >>> import tempfile, shutil
+    >>> cache_dir = tempfile.mkdtemp()
+    >>> @tiered_cache(os.path.join(cache_dir, 'cache.sqlite3'), maxsize=2)
+    ... def square(x):
+    ...     print(f'square({x}) is called')
+    ...     return x * x
+    >>> square(1), square(2), square(3)
+    square(1) is called
+    square(2) is called
+    square(3) is called
+    (1, 4, 9)
+    >>> square(3)  # memory hit
+    9
+    >>> square(1)  # disk hit, as square(1) is evicted from memory
+    1
+    >>> square.cache_stats
+    TieredCacheStats(num_memory_hits=1, num_disk_hits=1, num_misses=3, num_evictions=2)
+    >>> square.cache_clear()
+    >>> square(1)
+    square(1) is called
+    1
+    >>> shutil.rmtree(cache_dir)
+    '''
+
+    if cost_fn is None:
+        cost_fn = sys.getsizeof
+    if key is None:
+        key = _default_cache_key
+
+    def tiered_cache_decorator(func):
+        func_name = f'{func.__module__}.{func.__qualname__}'
+        store = None if db_path is None else _SqliteCacheStore(db_path, func_name)
+        memory = OrderedDict()  # key -> (value, cost)
+        total_cost = 0
+        stats = TieredCacheStats()
+        lock = threading.RLock()
+
+        def put_in_memory(cache_key, value):
+            nonlocal total_cost
+            cost = 0 if max_cost is None else cost_fn(value)
+            if cache_key in memory:
+                total_cost -= memory.pop(cache_key)[1]
+            memory[cache_key] = (value, cost)
+            total_cost += cost
+            while memory and ((maxsize is not None and len(memory) > maxsize) or
+                              (max_cost is not None and total_cost > max_cost)):
+                _, (_, evicted_cost) = memory.popitem(last=False)
+                total_cost -= evicted_cost
+                stats.num_evictions += 1
+
+        @functools.wraps(func)
+        def tiered_cache_func(*args, **kwargs):
+            cache_key = key(*args, **kwargs)
+            with lock:
+                if cache_key in memory:
+                    memory.move_to_end(cache_key)
+                    stats.num_memory_hits += 1
+                    return memory[cache_key][0]
+                if store is not None:
+                    key_digest = _get_digest(cache_key)
+                    value = store.get(key_digest)
+                    if value is not NO_VALUE:
+                        stats.num_disk_hits += 1
+                        put_in_memory(cache_key, value)
+                        return value
+
+            value = func(*args, **kwargs)
+
+            with lock:
+                stats.num_misses += 1
+                if store is not None:
+                    store.put(key_digest, value)
+                put_in_memory(cache_key, value)
+            return value
+
+        def cache_clear():
+            nonlocal total_cost
+            with lock:
+                memory.clear()
+                total_cost = 0
+                if store is not None:
+                    store.clear()
+
+        tiered_cache_func.cache_stats = stats
+        tiered_cache_func.cache_clear = cache_clear
+
+        return tiered_cache_func
+
+    return tiered_cache_decorator
+
+
+def singleflight_cache(ttl=None, *, key=None):
+    '''
+    Thread-safe cache for both normal functions and coroutine functions.
+    Concurrent calls with the same key share a single in-flight computation,
+    and the result is stored when the computation is finished successfully.
+
+    :param ttl: The time-to-live (seconds) of a stored result. None means no expiration.
+        `ttl` can also be a function that takes a result and returns its time-to-live.
+    :param key: A function that computes a hashable key from arguments.
+        The default key consists of the positional arguments and the sorted keyword arguments.
+
+    The decorated function has the following attributes:
+
+    - `cache`: a dictionary that maps keys to pairs of results and expiration times
+    - `cache_clear()`
+
+    Example 1 (threads)
+
+    >>> import time
+    >>> from concurrent.futures import ThreadPoolExecutor
+    >>> @singleflight_cache()
+    ... def slow_square(x):
+    ...     print(f'slow_square({x}) is called')
+    ...     time.sleep(0.1)
+    ...     return x * x
+    >>> with ThreadPoolExecutor(4) as executor:
+    ...     print(list(executor.map(slow_square, [3, 3, 3, 3])))
+    slow_square(3) is called
+    [9, 9, 9, 9]
+
+    Example 2 (coroutines)
+
+    >>> import asyncio
+    >>> @singleflight_cache(ttl=60)
+    ... async def async_square(x):
+    ...     print(f'async_square({x}) is called')
+    ...     await asyncio.sleep(0.1)
+    ...     return x * x
+    >>> async def main():
+    ...     return await asyncio.gather(*[async_square(3) for _ in range(4)])
+    >>> asyncio.run(main())
+    async_square(3) is called
+    [9, 9, 9, 9]
+    '''
+
+    import time
+
+    if key is None:
+        key = _default_cache_key
+
+    if ttl is None or callable(ttl):
+        get_ttl = ttl
+    else:
+        def get_ttl(value):
+            return ttl
+
+    def singleflight_cache_decorator(func):
+        results = {}  # key -> (value, expiration time)
+        in_flight = {}  # key -> future
+        lock = threading.Lock()
+
+        def get_result(cache_key):
+            # This function should be called while holding `lock`
+            entry = results.get(cache_key)
+            if entry is not None:
+                value, expiration_time = entry
+                if expiration_time is None or time.monotonic() < expiration_time:
+                    return value
+                else:
+                    del results[cache_key]
+            return NO_VALUE
+
+        def set_result(cache_key, value):
+            # This function should be called while holding `lock`
+            expiration_time = None if get_ttl is None else time.monotonic() + get_ttl(value)
+            results[cache_key] = (value, expiration_time)
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def singleflight_cache_func(*args, **kwargs):
+                cache_key = key(*args, **kwargs)
+                with lock:
+                    value = get_result(cache_key)
+                    if value is not NO_VALUE:
+                        return value
+                    task = in_flight.get(cache_key)
+                    if task is None:
+                        # The computation is a separate task, so it continues even if its first caller is cancelled.
+                        task = asyncio.ensure_future(func(*args, **kwargs))
+                        in_flight[cache_key] = task
+
+                        def on_done(task):
+                            with lock:
+                                del in_flight[cache_key]
+                                if not task.cancelled() and task.exception() is None:
+                                    set_result(cache_key, task.result())
+
+                        task.add_done_callback(on_done)
+                return await asyncio.shield(task)
+        else:
+            @functools.wraps(func)
+            def singleflight_cache_func(*args, **kwargs):
+                cache_key = key(*args, **kwargs)
+                with lock:
+                    value = get_result(cache_key)
+                    if value is not NO_VALUE:
+                        return value
+                    future = in_flight.get(cache_key)
+                    computing = future is None
+                    if computing:
+                        future = concurrent.futures.Future()
+                        in_flight[cache_key] = future
+
+                if not computing:
+                    return future.result()
+
+                try:
+                    value = func(*args, **kwargs)
+                except BaseException as exception:
+                    with lock:
+                        del in_flight[cache_key]
+                    future.set_exception(exception)
+                    raise
+                with lock:
+                    del in_flight[cache_key]
+                    set_result(cache_key, value)
+                future.set_result(value)
+                return value
+
+        def cache_clear():
+            with lock:
+                results.clear()
+
+        singleflight_cache_func.cache = results
+        singleflight_cache_func.cache_clear = cache_clear
+
+        return singleflight_cache_func
+
+    return singleflight_cache_decorator
+
+
 # Register
 class Register:
     '''
@@ -322,7 +1212,7 @@ class Register:
             identifier = tuple(identifier)
         return identifier
 
-    @curry
+    @compiled_curry
     def __call__(self, identifier, obj):
         identifier = self._normalize_identifier(identifier)
 
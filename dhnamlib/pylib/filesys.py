@@ -1,6 +1,7 @@
 
 import sys
 import os
+import ast
 import io
 import json
 import pickle
@@ -13,8 +14,21 @@ import glob
 import re
 import itertools
 import fractions
+import gc
+import contextlib
+import dis
+import functools
+import importlib.util
+import multiprocessing
+import mmap
+import gzip
+import struct
+import marshal
+from array import array
+from collections import deque
 
 from .constant import NO_VALUE
+from .time import TimeMeasure
 
 
 try:
@@ -27,6 +41,32 @@ try:
 except ModuleNotFoundError:
     pass
 
+try:
+    import fcntl
+except ModuleNotFoundError:
+    # e.g. Windows
+    pass
+
+try:
+    import numpy
+except ModuleNotFoundError:
+    pass
+
+try:
+    import msgpack
+except ModuleNotFoundError:
+    pass
+
+try:
+    import zstandard
+except ModuleNotFoundError:
+    pass
+
+try:
+    import lz4.frame
+except ModuleNotFoundError:
+    pass
+
 
 def get_os_independent_path(path):
     return os.path.join(*path.split('/'))
@@ -140,6 +180,248 @@ def get_parent_path(path, depth=1):
     return pathlib.Path(path).parents[depth - 1].as_posix()
 
 
+COMPRESSION_EXTENSION_DICT = {
+    '.gz': 'gzip',
+    '.zst': 'zstd',
+    '.zstd': 'zstd',
+    '.lz4': 'lz4',
+}
+
+
+def get_compression(path):
+    '''
+    Return the compression format of a file from the extension of its path.
+
+    Example:
+
+    >>> get_compression('path/to/file.json.gz')
+    'gzip'
+    >>> get_compression('path/to/file.json') is None
+    True
+    '''
+    _, extension = os.path.splitext(path)
+    return COMPRESSION_EXTENSION_DICT.get(extension)
+
+
+def open_compressed(path, mode='r', compression=NO_VALUE, **kwargs):
+    '''
+    Open a file that is transparently compressed.
+
+    :param compression: One of 'gzip', 'zstd', 'lz4' and None (no compression).
+        By default, the compression format is chosen by the extension of `path`.
+    '''
+
+    if compression is NO_VALUE:
+        compression = get_compression(path)
+
+    if compression is None:
+        return open(path, mode, **kwargs)
+    else:
+        if 'b' not in mode and 't' not in mode:
+            mode = mode + 't'
+
+        if compression == 'gzip':
+            return gzip.open(path, mode, **kwargs)
+        elif compression == 'zstd':
+            return zstandard.open(path, mode, **kwargs)
+        elif compression == 'lz4':
+            return lz4.frame.open(path, mode, **kwargs)
+        else:
+            raise Exception(f'Unknown compression format: {compression}')
+
+
+def _make_temp_file(dir_path, prefix, suffix):
+    # Unlike `tempfile.mkstemp`, which makes a file with mode 0o600,
+    # the file is made with mode 0o666, which the OS restricts by the umask as for a newly opened file.
+    while True:
+        temp_path = os.path.join(dir_path, f'{prefix}{os.urandom(8).hex()}{suffix}')
+        try:
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        except FileExistsError:
+            continue
+        os.close(fd)
+        return temp_path
+
+
+class _AtomicOpen:
+    def __init__(self, path, mode, compression, kwargs):
+        # Reading or appending modes would lose the existing content, since a new file replaces `path`.
+        if not (mode[:1] in ['w', 'x'] and set(mode[1:]).issubset('bt')):
+            raise ValueError(f'The mode "{mode}" is not supported. Use a mode for writing such as "w", "wb" or "x".')
+        # A symbolic link is not replaced, but its target is.
+        self.path = os.path.realpath(path)
+        self.exclusive = mode[0] == 'x'
+        self.mode = 'w' + mode[1:]
+        self.compression = get_compression(path) if compression is NO_VALUE else compression
+        self.kwargs = kwargs
+
+    def __enter__(self):
+        if self.exclusive and os.path.exists(self.path):
+            raise FileExistsError(f'File exists: {self.path}')
+        dir_path, file_name = os.path.split(self.path)
+        self.temp_path = _make_temp_file(dir_path, prefix=f'.{file_name}.', suffix='.tmp')
+        if os.path.isfile(self.path):
+            shutil.copymode(self.path, self.temp_path)
+
+        try:
+            self.file = open_compressed(self.temp_path, self.mode, compression=self.compression, **self.kwargs)
+        except BaseException:
+            os.remove(self.temp_path)
+            raise
+        return self.file
+
+    def __exit__(self, except_type, except_value, except_traceback):
+        try:
+            self.file.close()
+            if except_type is None:
+                if self.exclusive:
+                    # Unlike `os.replace`, `os.link` fails when `path` is made by another process meanwhile.
+                    os.link(self.temp_path, self.path)
+                else:
+                    os.replace(self.temp_path, self.path)
+        finally:
+            if os.path.isfile(self.temp_path):
+                os.remove(self.temp_path)
+        return False
+
+
+def atomic_open(path, mode='w', compression=NO_VALUE, **kwargs):
+    '''
+    Open a temporary file in the same directory as `path` for writing,
+    then rename the temporary file to `path` when writing is finished without an exception.
+    Therefore, `path` never has a partially written file.
+
+    Only modes for writing ('w' or 'x' with optional 'b' or 't') are supported.
+    When `path` is a symbolic link, the target of the link is replaced.
+
+    Example:
+
+    >>> path = 'some-file.txt.gz'
+    >>> with atomic_open(path) as f:
+    ...     print('some text', file=f)
+    >>> with open_compressed(path) as f:
+    ...     f.read()
+    'some text\\n'
+    >>> try:
+    ...     with atomic_open(path) as f:
+    ...         print('other text', file=f)
+    ...         raise Exception('An error occurs while writing')
+    ... except Exception:
+    ...     pass
+    >>> with open_compressed(path) as f:
+    ...     f.read()
+    'some text\\n'
+    >>> atomic_open(path, 'a')
+    Traceback (most recent call last):
+        ...
+    ValueError: The mode "a" is not supported. Use a mode for writing such as "w", "wb" or "x".
+    >>> os.remove(path)
+    '''
+    return _AtomicOpen(path, mode, compression, kwargs)
+
+
+def open_for_saving(path, mode='w', atomic=True, **kwargs):
+    if atomic:
+        return atomic_open(path, mode, **kwargs)
+    else:
+        return open_compressed(path, mode, **kwargs)
+
+
+def get_lock_path(path):
+    # The lock file is hidden, so it's distinguished from regular files in the same directory.
+    dir_path, file_name = os.path.split(path)
+    return os.path.join(dir_path, f'.{file_name}.lock')
+
+
+class _FileLock:
+    def __init__(self, path, polling_interval):
+        self.lock_path = get_lock_path(path)
+        self.polling_interval = polling_interval
+
+    def __enter__(self):
+        if 'fcntl' in globals():
+            while True:
+                self.fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o666)
+                fcntl.flock(self.fd, fcntl.LOCK_EX)
+                # The lock file may have been removed by `remove_lock_file` while waiting for the lock
+                if _is_same_file(self.fd, self.lock_path):
+                    break
+                os.close(self.fd)
+        else:
+            import time
+            while True:
+                try:
+                    self.fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o666)
+                    break
+                except FileExistsError:
+                    time.sleep(self.polling_interval)
+        return self
+
+    def __exit__(self, except_type, except_value, except_traceback):
+        if 'fcntl' in globals():
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+        else:
+            os.close(self.fd)
+            os.remove(self.lock_path)
+        return False
+
+
+def _is_same_file(fd, path):
+    try:
+        return os.path.samestat(os.fstat(fd), os.stat(path))
+    except FileNotFoundError:
+        return False
+
+
+def file_lock(path, polling_interval=0.1):
+    '''
+    An exclusive inter-process lock for a path. The lock is held on a hidden file `.<file-name>.lock`.
+    On POSIX systems, `fcntl.flock` is used, so the lock is released even when a process crashes.
+    Otherwise, the lock file is exclusively created and a waiting process polls every `polling_interval` seconds.
+
+    Example:
+
+    >>> path = 'some-file.txt'
+    >>> with file_lock(path):
+    ...     write_text(path, 'text')
+    4
+    >>> os.remove(path)
+    >>> os.remove(get_lock_path(path))
+    '''
+    return _FileLock(path, polling_interval)
+
+
+def remove_lock_file(path):
+    '''
+    Remove the lock file of a path unless the lock is held.
+
+    :returns: True if the lock file is removed
+    '''
+    if 'fcntl' not in globals():
+        # The lock file exists only while the lock is held
+        return False
+
+    lock_path = get_lock_path(path)
+    try:
+        fd = os.open(lock_path, os.O_RDWR)
+    except FileNotFoundError:
+        return False
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        if _is_same_file(fd, lock_path):
+            os.remove(lock_path)
+            return True
+        else:
+            return False
+    finally:
+        # Closing the file releases the lock
+        os.close(fd)
+
+
 class ExtendedJSONEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, set):
@@ -152,7 +434,10 @@ class ExtendedJSONEncoder(json.JSONEncoder):
 
 def as_python_object_from_json(dic):
     # https://stackoverflow.com/a/8230373
-    if '__py__set' in dic:
+    if len(dic) != 1:
+        # Tagged objects have only one key
+        return dic
+    elif '__py__set' in dic:
         return set(dic['__py__set'])
     elif '__py__Fraction' in dic:
         return fractions.Fraction(*dic['__py__Fraction'])
@@ -258,8 +543,9 @@ def example_extended_json_encoder():
     print(json.loads(j, object_hook=as_python_object_from_json))
 
 
-def json_save(obj, path, **kwargs):
-    with open(path, 'w') as f:
+def json_save(obj, path, atomic=True, **kwargs):
+    # `json.dump` writes encoded chunks one by one rather than the whole serialized string.
+    with open_for_saving(path, 'w', atomic=atomic) as f:
         json.dump(obj, f, **kwargs)
 
 
@@ -276,7 +562,7 @@ def json_pretty_dump(obj, fp, **kwargs):
 
 
 def json_load(path, **kwargs):
-    with open(path) as f:
+    with open_compressed(path) as f:
         return json.load(f, **kwargs)
 
 
@@ -298,8 +584,163 @@ def extended_json_load(path, **kwargs):
     return json_load(path, **new_kwargs)
 
 
-def pickle_save(obj, path, **kwargs):
-    with open(path, 'wb') as f:
+# A tuple, a set, a frozenset or a Fraction is encoded as an array whose first item is an extension object
+# of its type, which is followed by its items. Therefore, nested containers are packed in a single pass.
+_MSGPACK_EXT_TUPLE = 1
+_MSGPACK_EXT_SET = 2
+_MSGPACK_EXT_FROZENSET = 3
+_MSGPACK_EXT_FRACTION = 4
+# An integer that exceeds the range of MessagePack integers is encoded as little-endian signed bytes.
+_MSGPACK_EXT_BIG_INT = 5
+
+_MSGPACK_MIN_INT = -2 ** 63
+_MSGPACK_MAX_INT = 2 ** 64 - 1
+
+
+class _MsgpackTypeMarker:
+    __slots__ = ('construct',)
+
+    def __init__(self, construct):
+        self.construct = construct
+
+
+_MSGPACK_TYPE_MARKER_DICT = {
+    _MSGPACK_EXT_TUPLE: _MsgpackTypeMarker(tuple),
+    _MSGPACK_EXT_SET: _MsgpackTypeMarker(set),
+    _MSGPACK_EXT_FROZENSET: _MsgpackTypeMarker(frozenset),
+    _MSGPACK_EXT_FRACTION: _MsgpackTypeMarker(lambda items: fractions.Fraction(*items)),
+}
+
+
+def _extended_msgpack_default(obj):
+    if isinstance(obj, tuple):
+        return [msgpack.ExtType(_MSGPACK_EXT_TUPLE, b''), *obj]
+    elif isinstance(obj, set):
+        return [msgpack.ExtType(_MSGPACK_EXT_SET, b''), *obj]
+    elif isinstance(obj, frozenset):
+        return [msgpack.ExtType(_MSGPACK_EXT_FROZENSET, b''), *obj]
+    elif isinstance(obj, fractions.Fraction):
+        return [msgpack.ExtType(_MSGPACK_EXT_FRACTION, b''), obj.numerator, obj.denominator]
+    elif isinstance(obj, dict):
+        return dict(obj)
+    elif isinstance(obj, list):
+        return list(obj)
+    elif isinstance(obj, str):
+        return str(obj)
+    elif isinstance(obj, int):
+        # A subclass of int, or an int out of the range
+        obj = int(obj)
+        if _MSGPACK_MIN_INT <= obj <= _MSGPACK_MAX_INT:
+            return obj
+        else:
+            return msgpack.ExtType(_MSGPACK_EXT_BIG_INT, obj.to_bytes(obj.bit_length() // 8 + 1, 'little', signed=True))
+    elif isinstance(obj, float):
+        # A subclass of float such as `numpy.float64`
+        return float(obj)
+    else:
+        raise TypeError(f'Object of type {type(obj).__name__} is not serializable')
+
+
+def _extended_msgpack_ext_hook(code, data):
+    if code == _MSGPACK_EXT_BIG_INT:
+        return int.from_bytes(data, 'little', signed=True)
+    else:
+        marker = _MSGPACK_TYPE_MARKER_DICT.get(code)
+        return msgpack.ExtType(code, data) if marker is None else marker
+
+
+def _extended_msgpack_list_hook(items):
+    if len(items) > 0 and type(items[0]) is _MsgpackTypeMarker:
+        return items[0].construct(items[1:])
+    else:
+        return items
+
+
+def extended_msgpack_dumps(obj):
+    '''
+    Serialize an object into the binary extended format,
+    which keeps tuples, sets, frozensets, Fractions, bytes and integers of any size.
+
+    The format is MessagePack where the extra types are marked by extension types.
+    When decoding, the objects are constructed by the C implementation of `msgpack`,
+    and only arrays and extension objects call the Python hooks.
+
+    Example:
+
+    >>> obj = [1, (2, (3, {4})), {'a': {4, 5}, 'b': fractions.Fraction(1, 3 ** 50)}, bytes([6, 7]), 'text', 2 ** 70]
+    >>> extended_msgpack_loads(extended_msgpack_dumps(obj)) == obj
+    True
+    >>> extended_msgpack_loads(extended_msgpack_dumps({(1, 2): -2 ** 100, 'x': numpy.float64(0.5)}))
+    {(1, 2): -1267650600228229401496703205376, 'x': 0.5}
+    '''
+    # `strict_types` makes tuples go to `_extended_msgpack_default` rather than being serialized as lists.
+    return msgpack.packb(obj, default=_extended_msgpack_default, use_bin_type=True, strict_types=True)
+
+
+def extended_msgpack_loads(data):
+    return msgpack.unpackb(data, ext_hook=_extended_msgpack_ext_hook, list_hook=_extended_msgpack_list_hook,
+                           raw=False, strict_map_key=False)
+
+
+def extended_msgpack_save(obj, path, atomic=True):
+    with open_for_saving(path, 'wb', atomic=atomic) as f:
+        f.write(extended_msgpack_dumps(obj))
+
+
+@contextlib.contextmanager
+def _disabling_gc():
+    # Cyclic garbage collection is repeatedly triggered while a large number of containers are created,
+    # though no cycle is made when decoding.
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def extended_msgpack_load(path):
+    with open_compressed(path, 'rb') as f:
+        data = f.read()
+    with _disabling_gc():
+        return extended_msgpack_loads(data)
+
+
+def benchmark_extended_formats(obj=None, num_repeats=3):
+    '''
+    Compare saving and loading time between `extended_json` and `extended_msgpack`.
+
+    Example:
+
+    >>> benchmark_extended_formats()  # doctest: +SKIP
+    '''
+
+    if obj is None:
+        obj = [dict(idx=idx, tokens=[f'token-{idx}'] * 10, labels=set(range(idx % 5)), score=fractions.Fraction(idx, 7))
+               for idx in range(100000)]
+
+    temp_dir_path = tempfile.mkdtemp()
+    try:
+        for format_name, save_fn, load_fn in [
+                ('extended_json', extended_json_save, extended_json_load),
+                ('extended_msgpack', extended_msgpack_save, extended_msgpack_load)]:
+            path = os.path.join(temp_dir_path, format_name)
+            with TimeMeasure() as save_tm:
+                for _ in range(num_repeats):
+                    save_fn(obj, path)
+            with TimeMeasure() as load_tm:
+                for _ in range(num_repeats):
+                    loaded_obj = load_fn(path)
+            assert loaded_obj == obj
+            print('{}: save {:.3f}s, load {:.3f}s, size {} bytes'.format(
+                format_name, save_tm.interval / num_repeats, load_tm.interval / num_repeats, os.path.getsize(path)))
+    finally:
+        shutil.rmtree(temp_dir_path)
+
+
+def pickle_save(obj, path, atomic=True, **kwargs):
+    with open_for_saving(path, 'wb', atomic=atomic) as f:
         pickle.dump(obj, f, **kwargs)
 
 
@@ -310,10 +751,184 @@ def pickle_save_highest(obj, path, **kwargs):
 
 
 def pickle_load(path, **kwargs):
-    with open(path, 'rb') as f:
+    with open_compressed(path, 'rb') as f:
         return pickle.load(f, **kwargs)
 
 
+def _to_numpy_array(array):
+    if type(array).__module__ == 'torch':
+        # torch.Tensor
+        return array.detach().cpu().numpy()
+    else:
+        return numpy.asarray(array)
+
+
+def _to_tensor(array):
+    import torch
+    return torch.from_numpy(array)
+
+
+def array_save(array, path, atomic=True):
+    '''
+    Save a NumPy array or a PyTorch tensor in the `.npy` format.
+    '''
+    with open_for_saving(path, 'wb', atomic=atomic, compression=None) as f:
+        numpy.save(f, _to_numpy_array(array), allow_pickle=False)
+
+
+def array_load(path, mmap_mode='r', as_tensor=False):
+    '''
+    Load an array saved by `array_save`.
+
+    :param mmap_mode: The mode of memory mapping, which is passed to `numpy.load`.
+        With memory mapping, a large array opens instantly and its pages are shared across processes through the page cache.
+        When `mmap_mode` is None, the whole array is read into memory.
+    :param as_tensor: If True, the output is converted to a PyTorch tensor which shares memory with the array.
+        Since tensors should be writable, use `mmap_mode='c'` (copy-on-write) with `as_tensor=True`.
+
+    Example:
+
+    >>> path = 'some-array.npy'
+    >>> array_save(numpy.arange(6, dtype=numpy.float32).reshape(2, 3), path)
+    >>> array = array_load(path)
+    >>> type(array).__name__, array.shape, float(array[1, 2])
+    ('memmap', (2, 3), 5.0)
+    >>> os.remove(path)
+    '''
+    array = numpy.load(path, mmap_mode=mmap_mode, allow_pickle=False)
+    return _to_tensor(array) if as_tensor else array
+
+
+# The bundle format follows the layout of safetensors:
+# - 8 bytes: the size of a header as a little-endian unsigned 64-bit integer
+# - the header: a JSON object which maps a name to the dtype, shape and data offsets of an array,
+#   where the optional key "__metadata__" maps to a dictionary of strings
+# - the data: the concatenated bytes of arrays in the C order and the little-endian byte order
+# https://github.com/huggingface/safetensors#format
+
+_ARRAY_BUNDLE_DTYPE_DICT = dict(
+    F64='<f8', F32='<f4', F16='<f2',
+    I64='<i8', I32='<i4', I16='<i2', I8='|i1',
+    U64='<u8', U32='<u4', U16='<u2', U8='|u1',
+    BOOL='|b1')
+_ARRAY_BUNDLE_DTYPE_NAME_DICT = {numpy_dtype: dtype_name for dtype_name, numpy_dtype in _ARRAY_BUNDLE_DTYPE_DICT.items()}
+_ARRAY_BUNDLE_HEADER_SIZE_FORMAT = '<Q'
+_ARRAY_BUNDLE_METADATA_KEY = '__metadata__'
+
+
+def array_bundle_save(arrays, path, metadata=None, atomic=True):
+    '''
+    Save a dictionary of arrays (or tensors) in a single file whose layout follows safetensors.
+
+    :param arrays: A dictionary from names to arrays
+    :param metadata: A dictionary from strings to strings
+    '''
+    header = {}
+    numpy_arrays = []
+    offset = 0
+    for name, array in arrays.items():
+        assert name != _ARRAY_BUNDLE_METADATA_KEY
+        numpy_array = _to_numpy_array(array)
+        dtype = numpy_array.dtype.newbyteorder('<') if numpy_array.dtype.byteorder == '>' else numpy_array.dtype
+        dtype_name = _ARRAY_BUNDLE_DTYPE_NAME_DICT.get(numpy.dtype(dtype).str)
+        if dtype_name is None:
+            raise Exception(f'The dtype {numpy_array.dtype} is not supported')
+        # Unlike `numpy.ascontiguousarray`, `numpy.require` keeps the shape of a 0-d array.
+        numpy_array = numpy.require(numpy_array, dtype=dtype, requirements='C')
+        header[name] = dict(dtype=dtype_name, shape=list(numpy_array.shape),
+                            data_offsets=[offset, offset + numpy_array.nbytes])
+        numpy_arrays.append(numpy_array)
+        offset += numpy_array.nbytes
+    if metadata is not None:
+        header[_ARRAY_BUNDLE_METADATA_KEY] = metadata
+
+    header_bytes = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    # The header is padded with spaces, so the data starts at a multiple of 8 bytes
+    header_bytes += b' ' * (-len(header_bytes) % 8)
+
+    with open_for_saving(path, 'wb', atomic=atomic, compression=None) as f:
+        f.write(struct.pack(_ARRAY_BUNDLE_HEADER_SIZE_FORMAT, len(header_bytes)))
+        f.write(header_bytes)
+        for numpy_array in numpy_arrays:
+            f.write(memoryview(numpy_array.reshape(-1)).cast('B'))
+
+
+def _read_array_bundle_header(f):
+    size_bytes = f.read(struct.calcsize(_ARRAY_BUNDLE_HEADER_SIZE_FORMAT))
+    [header_size] = struct.unpack(_ARRAY_BUNDLE_HEADER_SIZE_FORMAT, size_bytes)
+    header = json.loads(f.read(header_size))
+    return header, len(size_bytes) + header_size
+
+
+def array_bundle_load(path, mmap_mode='r', as_tensor=False):
+    '''
+    Load a dictionary of arrays saved by `array_bundle_save`.
+
+    :param mmap_mode: 'r' (read-only), 'c' (copy-on-write) or None (read into memory).
+        With memory mapping, arrays are views of the mapped file, so they open instantly and
+        their pages are shared across processes through the page cache.
+    :param as_tensor: If True, the arrays are converted to PyTorch tensors which share memory with the arrays.
+        Since tensors should be writable, use `mmap_mode='c'` with `as_tensor=True`.
+
+    Example:
+
+    >>> path = 'some-bundle.safetensors'
+    >>> array_bundle_save(dict(a=numpy.arange(3, dtype=numpy.int64), b=numpy.ones((2, 2), dtype=numpy.float16)), path)
+    >>> arrays = array_bundle_load(path)
+    >>> arrays['a'].tolist(), arrays['b'].tolist()
+    ([0, 1, 2], [[1.0, 1.0], [1.0, 1.0]])
+    >>> array_bundle_load_metadata(path) is None
+    True
+
+    0-d arrays and zero-size arrays keep their shapes.
+
+    >>> array_bundle_save(dict(a=numpy.array(7, dtype=numpy.int32), b=numpy.zeros((0, 3), dtype=numpy.float32)), path)
+    >>> arrays = array_bundle_load(path)
+    >>> arrays['a'].shape, int(arrays['a']), arrays['b'].shape
+    ((), 7, (0, 3))
+    >>> array_bundle_save(dict(b=numpy.zeros((0, 3), dtype=numpy.float32)), path)
+    >>> array_bundle_load(path)['b'].shape
+    (0, 3)
+    >>> os.remove(path)
+    '''
+
+    assert mmap_mode in ['r', 'c', None]
+
+    with open(path, 'rb') as f:
+        header, data_start = _read_array_bundle_header(f)
+        if mmap_mode is None:
+            buffer = f.read()
+            data_start = 0
+        elif os.fstat(f.fileno()).st_size > data_start:
+            buffer = mmap.mmap(f.fileno(), 0, access=(mmap.ACCESS_READ if mmap_mode == 'r' else mmap.ACCESS_COPY))
+        else:
+            buffer = b''
+
+    arrays = {}
+    for name, info in header.items():
+        if name == _ARRAY_BUNDLE_METADATA_KEY:
+            continue
+        dtype = numpy.dtype(_ARRAY_BUNDLE_DTYPE_DICT[info['dtype']])
+        start, end = info['data_offsets']
+        if end == start:
+            # `numpy.frombuffer` cannot read zero bytes at the end of a buffer
+            array = numpy.empty(info['shape'], dtype=dtype)
+        else:
+            array = numpy.frombuffer(buffer, dtype=dtype, count=(end - start) // dtype.itemsize,
+                                     offset=data_start + start).reshape(info['shape'])
+        if mmap_mode is None:
+            array = array.copy()
+        arrays[name] = _to_tensor(array) if as_tensor else array
+
+    return arrays
+
+
+def array_bundle_load_metadata(path):
+    with open(path, 'rb') as f:
+        header, _ = _read_array_bundle_header(f)
+    return header.get(_ARRAY_BUNDLE_METADATA_KEY)
+
+
 def write_text(path, text):
     with open(path, 'w') as f:
         return f.write(text)
@@ -360,14 +975,427 @@ def python_load(path, *args):
     return eval(read_text(path), *args)
 
 
+# The opcodes are checked for CPython 3.6 to 3.13.
+# When a newer CPython compiles literals into other opcodes, `ast.literal_eval` is used instead.
+_PYTHON_LITERAL_OPNAMES = (
+    # loading and building literals
+    'CACHE', 'NOP', 'RESUME', 'EXTENDED_ARG', 'LOAD_CONST', 'RETURN_VALUE', 'RETURN_CONST',
+    'BUILD_TUPLE', 'BUILD_LIST', 'BUILD_SET', 'BUILD_MAP', 'BUILD_CONST_KEY_MAP',
+    'LIST_APPEND', 'SET_ADD', 'MAP_ADD', 'LIST_EXTEND', 'SET_UPDATE', 'DICT_UPDATE',
+    'LIST_TO_TUPLE', 'UNARY_NEGATIVE', 'UNARY_POSITIVE', 'CALL_INTRINSIC_1',
+    # calling `set` or `frozenset` for `set()` and `frozenset({...})`
+    'LOAD_NAME', 'PUSH_NULL', 'PRECALL', 'CALL', 'CALL_FUNCTION',
+)
+_PYTHON_LITERAL_OPCODES = frozenset(dis.opmap[opname] for opname in _PYTHON_LITERAL_OPNAMES
+                                    if opname in dis.opmap)
+_PYTHON_LITERAL_NAME_DICT = dict(set=set, frozenset=frozenset)
+_PYTHON_LITERAL_GLOBALS = dict(__builtins__={}, **_PYTHON_LITERAL_NAME_DICT)
+
+
+def python_literal_eval(text, source='<python-literal>'):
+    '''
+    Safe alternative of `eval` for the output of `repr`, such as the content of `python_save` files.
+
+    The text is compiled by the C compiler, then the bytecode is checked to include only
+    instructions that load constants, build containers and call `set` or `frozenset`.
+    Unlike `ast.literal_eval`, no Python-level AST object is created,
+    so it runs faster than `ast.literal_eval`.
+    When the bytecode includes an instruction that is not known to be safe, such as one of a newer CPython,
+    `ast.literal_eval` is used instead.
+
+    Example:
+
+    >>> python_literal_eval("{'a': [1, -2.5, (3, None)], 'b': {3, 4}, 'c': set(), 'd': b'y'}")
+    {'a': [1, -2.5, (3, None)], 'b': {3, 4}, 'c': set(), 'd': b'y'}
+    >>> python_literal_eval("__import__('os').getcwd()")
+    Traceback (most recent call last):
+        ...
+    ValueError: The text includes a non-literal expression
+    '''
+
+    code = compile(text, source, 'eval', dont_inherit=True)
+    if (set(code.co_names).issubset(_PYTHON_LITERAL_NAME_DICT) and
+            set(code.co_code[::2]).issubset(_PYTHON_LITERAL_OPCODES)):
+        return eval(code, dict(_PYTHON_LITERAL_GLOBALS))
+    else:
+        # The text is not a literal, or it's compiled into opcodes that are unknown to `_PYTHON_LITERAL_OPNAMES`.
+        try:
+            return ast.literal_eval(text)
+        except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+            raise ValueError('The text includes a non-literal expression')
+
+
+# (mtime_ns, size, marshal version) of the source file, which precedes the marshal data in a cache file
+_PYTHON_LITERAL_CACHE_HEADER = struct.Struct('<qqi')
+
+
+def get_python_literal_cache_path(path):
+    return f'{path}.cache.marshal'
+
+
+def python_literal_load(path, caching=False):
+    '''
+    Safe version of `python_load`, which evaluates only Python literals. See `python_literal_eval`.
+
+    :param caching: If True, the loaded object is saved as a sidecar file in the `marshal` format,
+        which is reused while the modification time and the size of `path` are unchanged.
+        Unlike pickle, `marshal` never calls Python code when decoding,
+        and the data is decoded only after the header matches `path`.
+
+    Example:
+
+    >>> path = 'some-file.py'
+    >>> python_pretty_save({'a': (1, 2), 'b': {3}}, path)
+    >>> python_literal_load(path, caching=True)
+    {'a': (1, 2), 'b': {3}}
+    >>> python_literal_load(path, caching=True)  # loaded from the cache
+    {'a': (1, 2), 'b': {3}}
+    >>> os.remove(path)
+    >>> os.remove(get_python_literal_cache_path(path))
+    '''
+
+    if caching:
+        stat = os.stat(path)
+        cache_header = _PYTHON_LITERAL_CACHE_HEADER.pack(stat.st_mtime_ns, stat.st_size, marshal.version)
+        cache_path = get_python_literal_cache_path(path)
+        if os.path.isfile(cache_path):
+            with open(cache_path, 'rb') as f:
+                if f.read(_PYTHON_LITERAL_CACHE_HEADER.size) == cache_header:
+                    try:
+                        return marshal.loads(f.read())
+                    except (EOFError, ValueError, TypeError):
+                        pass
+
+    obj = python_literal_eval(read_text(path), path)
+
+    if caching:
+        with open_for_saving(cache_path, 'wb') as f:
+            f.write(cache_header)
+            f.write(marshal.dumps(obj))
+
+    return obj
+
+
 def jsonl_save(objects, path, **kwargs):
     with jsonlines.open(path, mode='w') as writer:
         for obj in objects:
             writer.write(obj)
 
 def jsonl_load(path, **kwargs):
-    with jsonlines.open(path) as reader:
-        return tuple(reader)
+    return tuple(iter_jsonl(path, **kwargs))
+
+
+JSON_DECODER_BACKENDS = ('orjson', 'msgspec', 'json')
+
+
+class _FallbackJSONDecoder:
+    # A class rather than a closure, so it can be pickled with `JsonlIndex`.
+
+    def __init__(self, decode, decode_error_types):
+        self.decode = decode
+        self.decode_error_types = decode_error_types
+
+    def __call__(self, text):
+        try:
+            return self.decode(text)
+        except self.decode_error_types:
+            # Such as NaN and Infinity, which are accepted by `json`
+            return json.loads(text)
+
+
+def _get_fast_json_decoder():
+    backend = next(backend for backend in JSON_DECODER_BACKENDS
+                   if importlib.util.find_spec(backend) is not None)
+    if backend == 'orjson':
+        import orjson
+        return _FallbackJSONDecoder(orjson.loads, orjson.JSONDecodeError)
+    elif backend == 'msgspec':
+        import msgspec
+        return _FallbackJSONDecoder(msgspec.json.decode, msgspec.DecodeError)
+    else:
+        return json.loads
+
+
+def get_json_decoder(backend=None):
+    '''
+    Return a function that decodes a JSON string or bytes.
+
+    :param backend: One of 'json', 'orjson', 'msgspec' and 'fast'.
+        When `backend` is None, 'json' is used.
+        When `backend` is 'fast', the first available backend in `JSON_DECODER_BACKENDS` is used,
+        and a text that it rejects is decoded again by `json`.
+        Note that 'orjson' and 'msgspec' reject NaN and Infinity, which `json` accepts,
+        and they don't keep integers that exceed 64 bits as `json` does.
+
+    Example:
+
+    >>> get_json_decoder('fast')('{"a": NaN, "b": Infinity}')
+    {'a': nan, 'b': inf}
+    '''
+
+    if backend is None or backend == 'json':
+        return json.loads
+    elif backend == 'orjson':
+        import orjson
+        return orjson.loads
+    elif backend == 'msgspec':
+        import msgspec
+        return msgspec.json.decode
+    elif backend == 'fast':
+        return _get_fast_json_decoder()
+    else:
+        raise Exception(f'Unknown JSON decoder backend: {backend}')
+
+
+def _project_keys(obj, keys):
+    return {key: obj[key] for key in keys if key in obj}
+
+
+def _parse_jsonl_lines(lines, decode, keys):
+    for line in lines:
+        if line.strip():
+            obj = decode(line)
+            yield obj if keys is None else _project_keys(obj, keys)
+
+
+def _parse_jsonl_chunk(path, start, end, backend, keys):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    return list(_parse_jsonl_lines(data.splitlines(), get_json_decoder(backend), keys))
+
+
+def iter_newline_aligned_ranges(path, chunk_size):
+    '''
+    Split a file into byte ranges whose boundaries are placed right after newline characters.
+    Each range has at least `chunk_size` bytes except the last range.
+    '''
+
+    file_size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        start = 0
+        while start < file_size:
+            if start + chunk_size < file_size:
+                f.seek(start + chunk_size - 1)
+                f.readline()
+                end = f.tell()
+            else:
+                end = file_size
+            yield start, end
+            start = end
+
+
+def iter_jsonl(path, *, backend=None, keys=None, num_processes=None, chunk_size=2 ** 24, mp=multiprocessing):
+    '''
+    Iterate objects in a JSON Lines file without loading the whole file.
+
+    :param backend: The JSON decoder backend. See `get_json_decoder`.
+    :param keys: When `keys` is given, each object is a dictionary that keeps only the keys in `keys`.
+    :param num_processes: When `num_processes` is given, the file is split into chunks at newline boundaries and
+        the chunks are parsed in a process pool. The order of objects is preserved.
+    :param chunk_size: The approximate number of bytes of a chunk.
+
+    Example:
+
+    >>> path = 'some-file.jsonl'
+    >>> with open(path, 'w') as f:
+    ...     for idx in range(5):
+    ...         print(json.dumps(dict(idx=idx, text=str(idx) * 3)), file=f)
+    >>> list(iter_jsonl(path, keys=['idx']))
+    [{'idx': 0}, {'idx': 1}, {'idx': 2}, {'idx': 3}, {'idx': 4}]
+    >>> list(iter_jsonl(path, num_processes=2, chunk_size=16)) == list(iter_jsonl(path, backend='fast'))
+    True
+    >>> os.remove(path)
+    '''
+
+    if keys is not None:
+        keys = tuple(keys)
+
+    if num_processes is None:
+        with open(path, 'rb') as f:
+            yield from _parse_jsonl_lines(f, get_json_decoder(backend), keys)
+    else:
+        parse_chunk = functools.partial(_parse_jsonl_chunk, path, backend=backend, keys=keys)
+        max_num_pending_chunks = num_processes * 2
+
+        with mp.Pool(num_processes) as pool:
+            async_results = deque()
+            for start, end in iter_newline_aligned_ranges(path, chunk_size):
+                if len(async_results) >= max_num_pending_chunks:
+                    yield from async_results.popleft().get()
+                async_results.append(pool.apply_async(parse_chunk, args=(start, end)))
+            while async_results:
+                yield from async_results.popleft().get()
+
+
+LINE_INDEX_EXTENSION = 'idx'
+
+
+def get_line_index_path(path):
+    return f'{path}.{LINE_INDEX_EXTENSION}'
+
+
+def build_line_index(path, index_path=None, buffer_size=2 ** 20):
+    '''
+    Build a sidecar file of line offsets, which is an array of unsigned 64-bit integers.
+    The array has (the number of lines + 1) offsets where the last offset is the file size.
+
+    Blank lines, which have only whitespace, are not indexed as `iter_jsonl` skips them.
+    Each offset is the start of a non-blank line, so the blank lines following a line are placed in its range.
+    '''
+
+    if index_path is None:
+        index_path = get_line_index_path(path)
+
+    with open(path, 'rb') as data_file, atomic_open(index_path, 'wb', compression=None) as index_file:
+        offsets = array('Q')
+        offset = 0
+        for line in data_file:
+            if line.strip():
+                offsets.append(offset)
+                if len(offsets) >= buffer_size:
+                    offsets.tofile(index_file)
+                    offsets = array('Q')
+            offset += len(line)
+        offsets.append(offset)
+        offsets.tofile(index_file)
+
+
+class LineIndex:
+    '''
+    Random access to lines of a text file through a sidecar index of line offsets.
+
+    The index is built once and saved as `<path>.idx`. It's rebuilt when the file is newer than the index.
+    Both the file and the index are memory-mapped, so a line is read in O(1) without scanning the file.
+    Memory maps are opened lazily, so the object can be pickled for worker processes.
+
+    Blank lines are skipped, and line endings of both '\\n' and '\\r\\n' are removed. See `build_line_index`.
+
+    Example:
+
+    >>> path = 'some-file.txt'
+    >>> write_lines(path, ['first', 'second', 'third', 'fourth'])
+    >>> line_index = LineIndex(path)
+    >>> len(line_index)
+    4
+    >>> line_index[1]
+    'second'
+    >>> line_index[-1]
+    'fourth'
+    >>> line_index[1:3]
+    ['second', 'third']
+    >>> with open(path, 'wb') as f:
+    ...     _ = f.write(b'first\\r\\n\\r\\nsecond\\r\\n  \\n')
+    >>> list(LineIndex(path))
+    ['first', 'second']
+    >>> os.remove(path)
+    >>> os.remove(get_line_index_path(path))
+    '''
+
+    def __init__(self, path, index_path=None):
+        self.path = path
+        self.index_path = get_line_index_path(path) if index_path is None else index_path
+
+        if not self._is_index_valid():
+            build_line_index(self.path, self.index_path)
+
+        self._data = None
+        self._offsets = None
+
+    def _is_index_valid(self):
+        if not os.path.isfile(self.index_path):
+            return False
+        elif os.path.getmtime(self.index_path) < os.path.getmtime(self.path):
+            return False
+        else:
+            index_size = os.path.getsize(self.index_path)
+            if index_size == 0 or index_size % array('Q').itemsize != 0:
+                return False
+            with open(self.index_path, 'rb') as f:
+                f.seek(index_size - array('Q').itemsize)
+                last_offset = array('Q', f.read())
+            return last_offset[0] == os.path.getsize(self.path)
+
+    @staticmethod
+    def _mmap(path):
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size > 0:
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                return b''
+
+    def _open(self):
+        self._data = self._mmap(self.path)
+        self._offsets = memoryview(self._mmap(self.index_path)).cast('Q')
+
+    @property
+    def offsets(self):
+        if self._offsets is None:
+            self._open()
+        return self._offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def get_line_bytes(self, idx):
+        offsets = self.offsets
+        line = self._data[offsets[idx]:offsets[idx + 1]]
+        end = line.find(b'\n')
+        if end >= 0:
+            # Following blank lines are also removed
+            line = line[:end]
+        if line[-1:] == b'\r':
+            line = line[:-1]
+        return line
+
+    def decode_line(self, line):
+        return line.decode('utf-8')
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[_idx] for _idx in range(*idx.indices(len(self)))]
+        else:
+            if idx < 0:
+                idx += len(self)
+            if not (0 <= idx < len(self)):
+                raise IndexError('line index out of range')
+            return self.decode_line(self.get_line_bytes(idx))
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.update(_data=None, _offsets=None)
+        return state
+
+
+class JsonlIndex(LineIndex):
+    '''
+    `LineIndex` whose lines are decoded as JSON objects.
+
+    Example:
+
+    >>> path = 'some-file.jsonl'
+    >>> write_lines(path, [json.dumps(dict(idx=idx)) for idx in range(5)])
+    >>> jsonl_index = JsonlIndex(path)
+    >>> jsonl_index[3]
+    {'idx': 3}
+    >>> with open(path, 'wb') as f:
+    ...     _ = f.write(b'{"a":1}\\r\\n\\r\\n{"a":2}')
+    >>> list(JsonlIndex(path)) == list(iter_jsonl(path)) == [{'a': 1}, {'a': 2}]
+    True
+    >>> os.remove(path)
+    >>> os.remove(get_line_index_path(path))
+    '''
+
+    def __init__(self, path, index_path=None, backend=None):
+        super().__init__(path, index_path)
+        self.decode_json = get_json_decoder(backend)
+
+    def decode_line(self, line):
+        return self.decode_json(line)
 
 
 def pandas_tsv_load(path, containing_header=NO_VALUE, column_names=NO_VALUE):
@@ -488,9 +1516,15 @@ class _PrepareDirectory:
 
     def __exit__(self, except_type, except_value, except_traceback):
         if (except_type, except_value, except_traceback) != (None, None, None):
+            shutil.rmtree(self.temp_dir_path, ignore_errors=True)
             return False
 
-        os.rename(self.temp_dir_path, self.dir_path)
+        try:
+            os.rename(self.temp_dir_path, self.dir_path)
+        except BaseException:
+            # e.g. another process has made `dir_path` concurrently
+            shutil.rmtree(self.temp_dir_path, ignore_errors=True)
+            raise
 
 
 def prepare_dir(dir_path):
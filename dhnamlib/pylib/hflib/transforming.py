@@ -1,14 +1,21 @@
 
+import os
+import mmap
+import hashlib
 import functools
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Callable
 
+import numpy as np
 import torch
 from transformers import LogitsProcessor
 from transformers.file_utils import add_start_docstrings
 from transformers.generation_logits_process import LOGITS_PROCESSOR_INPUTS_DOCSTRING
 
-from ..iteration import rcopy
-from ..decoration import deprecated
+from ..iteration import rcopy, chunk_sizes, split_by_lengths
+from ..decoration import deprecated, keyed_cache
+from ..filesys import prepare_dir
 
 from ..torchlib.dnn import mask_tensor, masked_log_softmax
 
@@ -17,18 +24,175 @@ def iter_token_ids(tokenizer):
     return range(len(tokenizer))
 
 
+# tokenizer -> (the length of the tokenizer, the fingerprint)
+_tokenizer_fingerprint_cache = weakref.WeakKeyDictionary()
+
+
+def get_tokenizer_fingerprint(tokenizer):
+    '''
+    Compute a string that identifies the vocabulary of a tokenizer.
+    The fingerprint changes when any token or its id, the special tokens or the added tokens are changed,
+    even if the name and the size of the tokenizer are the same (e.g. a tokenizer retrained at the same path).
+
+    Since hashing the vocabulary takes time, the fingerprint is memoized for each tokenizer object,
+    and it's computed again when tokens are added to the tokenizer.
+    '''
+
+    entry = _tokenizer_fingerprint_cache.get(tokenizer)
+    if entry is not None and entry[0] == len(tokenizer):
+        return entry[1]
+
+    fingerprint = _compute_tokenizer_fingerprint(tokenizer)
+    _tokenizer_fingerprint_cache[tokenizer] = (len(tokenizer), fingerprint)
+    return fingerprint
+
+
+def _compute_tokenizer_fingerprint(tokenizer):
+    hasher = hashlib.sha1()
+    for item in [type(tokenizer).__name__,
+                 tokenizer.name_or_path,
+                 len(tokenizer),
+                 tokenizer.vocab_size,
+                 tuple(tokenizer.all_special_ids),
+                 tuple(sorted(tokenizer.get_added_vocab().items()))]:
+        hasher.update(repr(item).encode('utf-8'))
+        hasher.update(b'\0')
+    for token, token_id in sorted(tokenizer.get_vocab().items(), key=lambda pair: pair[1]):
+        hasher.update(f'{token_id}\0{token}\0'.encode('utf-8'))
+    return hasher.hexdigest()
+
+
+class VocabIndex:
+    '''
+    Memoized vocabulary of a tokenizer, which consists of
+    an id-to-token array, a token-to-id dictionary and a special-token mask.
+
+    The index is saved as the following files in a directory:
+
+    - `tokens.bin`: the UTF-8 encoded tokens which are concatenated
+    - `offsets.npy`: the start and end offsets of tokens in `tokens.bin`
+    - `special_mask.npy`: the boolean mask of the default special tokens
+
+    A saved index is loaded via memory mapping, so tokens are decoded only when they are accessed.
+    '''
+
+    TOKENS_FILE_NAME = 'tokens.bin'
+    OFFSETS_FILE_NAME = 'offsets.npy'
+    SPECIAL_MASK_FILE_NAME = 'special_mask.npy'
+
+    def __init__(self, token_bytes, offsets, special_mask):
+        self._token_bytes = token_bytes
+        self._offsets = offsets
+        self.special_mask = special_mask
+        self._id_to_token = None
+        self._token_to_id = None
+
+    @classmethod
+    def from_tokenizer(cls, tokenizer):
+        # A single call of `convert_ids_to_tokens` with a list is much faster than a call per id.
+        tokens = tokenizer.convert_ids_to_tokens(list(iter_token_ids(tokenizer)))
+        for token in tokens:
+            assert token is not None
+            assert isinstance(token, str)
+
+        encoded_tokens = [token.encode('utf-8') for token in tokens]
+        offsets = np.zeros(len(encoded_tokens) + 1, dtype=np.int64)
+        np.cumsum([len(encoded_token) for encoded_token in encoded_tokens], out=offsets[1:])
+
+        special_mask = np.zeros(len(encoded_tokens), dtype=np.bool_)
+        special_mask[list(tokenizer.all_special_ids)] = True
+
+        vocab_index = cls(b''.join(encoded_tokens), offsets, special_mask)
+        vocab_index._id_to_token = tuple(tokens)
+        return vocab_index
+
+    def save(self, dir_path):
+        with prepare_dir(dir_path) as temp_dir_path:
+            with open(os.path.join(temp_dir_path, self.TOKENS_FILE_NAME), 'wb') as f:
+                f.write(self._token_bytes)
+            np.save(os.path.join(temp_dir_path, self.OFFSETS_FILE_NAME), self._offsets)
+            np.save(os.path.join(temp_dir_path, self.SPECIAL_MASK_FILE_NAME), self.special_mask)
+
+    @classmethod
+    def load(cls, dir_path):
+        with open(os.path.join(dir_path, cls.TOKENS_FILE_NAME), 'rb') as f:
+            if os.fstat(f.fileno()).st_size > 0:
+                token_bytes = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                token_bytes = b''
+        offsets = np.load(os.path.join(dir_path, cls.OFFSETS_FILE_NAME), mmap_mode='r')
+        special_mask = np.load(os.path.join(dir_path, cls.SPECIAL_MASK_FILE_NAME), mmap_mode='r')
+        return cls(token_bytes, offsets, special_mask)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def get_token(self, token_id):
+        if self._id_to_token is not None:
+            return self._id_to_token[token_id]
+        else:
+            return self._token_bytes[self._offsets[token_id]:self._offsets[token_id + 1]].decode('utf-8')
+
+    @property
+    def id_to_token(self):
+        if self._id_to_token is None:
+            offsets = self._offsets.tolist()
+            token_bytes = self._token_bytes
+            self._id_to_token = tuple(
+                token_bytes[start:end].decode('utf-8')
+                for start, end in zip(offsets[:-1], offsets[1:]))
+        return self._id_to_token
+
+    @property
+    def token_to_id(self):
+        if self._token_to_id is None:
+            self._token_to_id = dict(map(reversed, enumerate(self.id_to_token)))
+        return self._token_to_id
+
+
+def get_default_vocab_index_cache_dir():
+    return os.environ.get(
+        'DHNAMLIB_VOCAB_INDEX_CACHE_DIR',
+        os.path.join(os.path.expanduser('~'), '.cache', 'dhnamlib', 'vocab_index'))
+
+
+@keyed_cache(lambda tokenizer, cache_dir=None, saving=True: get_tokenizer_fingerprint(tokenizer))
+def get_vocab_index(tokenizer, cache_dir=None, saving=True):
+    '''
+    Return the `VocabIndex` of a tokenizer.
+
+    The index is memoized by the fingerprint of the tokenizer.
+    Unless the index is memoized, it's loaded from `cache_dir` or
+    computed from the tokenizer and then saved to `cache_dir` when `saving` is True.
+
+    :param cache_dir: The directory where indices are saved.
+        When `cache_dir` is None, `$DHNAMLIB_VOCAB_INDEX_CACHE_DIR` or `~/.cache/dhnamlib/vocab_index` is used.
+    '''
+
+    if cache_dir is None:
+        cache_dir = get_default_vocab_index_cache_dir()
+    dir_path = os.path.join(cache_dir, get_tokenizer_fingerprint(tokenizer))
+
+    if os.path.isdir(dir_path):
+        return VocabIndex.load(dir_path)
+    else:
+        vocab_index = VocabIndex.from_tokenizer(tokenizer)
+        if saving:
+            try:
+                vocab_index.save(dir_path)
+            except (OSError, AssertionError):
+                # Another process may have saved the same index concurrently.
+                if not os.path.isdir(dir_path):
+                    raise
+        return vocab_index
+
+
 def iter_tokens(tokenizer):
-    for token in map(tokenizer.convert_ids_to_tokens, iter_token_ids(tokenizer)):
-        assert token is not None
-        yield token
+    return iter(get_vocab_index(tokenizer).id_to_token)
 
 
 def iter_id_token_pairs(tokenizer):
-    token_ids = tuple(iter_token_ids(tokenizer))
-    tokens = map(tokenizer.convert_ids_to_tokens, token_ids)
-    for token_id, token in zip(token_ids, tokens):
-        assert token is not None
-        yield token_id, token
+    return enumerate(get_vocab_index(tokenizer).id_to_token)
 
 
 def all_default_special_tokens(tokenizer):
@@ -38,13 +202,11 @@ def all_default_special_tokens(tokenizer):
 
 def iter_default_non_special_tokens(tokenizer):
     # the output doesn't include added tokens
-    default_special_ids = set(tokenizer.all_special_ids)
+    vocab_index = get_vocab_index(tokenizer)
+    special_mask = vocab_index.special_mask
     for token_id in range(tokenizer.vocab_size):
-        if token_id not in default_special_ids:
-            special_token = tokenizer.convert_ids_to_tokens(token_id)
-            assert special_token is not None
-            assert isinstance(special_token, str)
-            yield special_token
+        if not special_mask[token_id]:
+            yield vocab_index.get_token(token_id)
 
 
 def join_tokens(
@@ -62,6 +224,41 @@ def join_tokens(
         **kwargs)
 
 
+def batch_join_tokens(
+        tokenizer,
+        token_seqs,
+        skip_special_tokens: bool = False,
+        clean_up_tokenization_spaces: bool = True,
+        num_threads: int = None,
+        **kwargs):
+    '''
+    Batched version of `join_tokens`.
+
+    Tokens are converted to ids through the cached `VocabIndex`, and `tokenizer.batch_decode` is called once.
+    When `num_threads` is given and the tokenizer is a fast tokenizer,
+    the sequences are split into chunks which are decoded in a thread pool.
+    '''
+
+    token_to_id = get_vocab_index(tokenizer).token_to_id
+    unk_token_id = tokenizer.unk_token_id
+    token_id_seqs = [[token_to_id.get(token, unk_token_id) for token in tokens]
+                     for tokens in token_seqs]
+
+    def decode(sub_token_id_seqs):
+        return tokenizer.batch_decode(
+            sub_token_id_seqs,
+            skip_special_tokens=skip_special_tokens,
+            clean_up_tokenization_spaces=clean_up_tokenization_spaces,
+            **kwargs)
+
+    if num_threads is None or num_threads <= 1 or not tokenizer.is_fast or len(token_id_seqs) < num_threads:
+        return decode(token_id_seqs)
+    else:
+        token_id_seq_chunks = split_by_lengths(token_id_seqs, tuple(chunk_sizes(len(token_id_seqs), num_threads)))
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            return [text for texts in executor.map(decode, token_id_seq_chunks) for text in texts]
+
+
 def logit_rescaling(logits_processor: LogitsProcessor, num_beams=None, postprocessing_nan=False):
     # if num_beams is not None:
     #     assert not hasattr(logits_processor, '_num_beams')
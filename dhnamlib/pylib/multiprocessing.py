@@ -1,28 +1,128 @@
 
 import multiprocessing
-from queue import Empty
+import multiprocessing.connection
+import traceback
+import asyncio
+import concurrent.futures
+import functools
+import queue
+import time
+import itertools
+import sys
+import weakref
 from itertools import chain
+from collections import deque
 from abc import ABCMeta, abstractmethod
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
 
-from .iteration import distinct_pairs
+from .iteration import distinct_pairs, partition
+from .constant import NO_VALUE
+
+try:
+    import numpy
+except ModuleNotFoundError:
+    pass
 
 # import multiprocessing as mp
 # from multiprocessing import Pool
 
 
-def map_with_apply_async(fn, iterable, *, num_processes, mp=multiprocessing):
+def _apply_to_chunk(fn, chunk):
+    start_time = time.perf_counter()
+    outputs = [fn(elem) for elem in chunk]
+    return outputs, time.perf_counter() - start_time
+
+
+def imap_with_apply_async(fn, iterable, *, num_processes, chunk_size=None, ordered=True, max_in_flight=None,
+                          target_chunk_time=0.1, max_chunk_size=2 ** 14, mp=multiprocessing):
+    """
+    Return a generator that applies `fn` to elements of `iterable` with a process pool.
+
+    Elements are sent in chunks, and at most `max_in_flight` chunks are sent but not returned,
+    so the memory usage is bounded even for an unbounded iterable.
+
+    :param chunk_size: The number of elements in a chunk. When `chunk_size` is None,
+        it starts from 1 and is adapted so that processing a chunk takes about `target_chunk_time` seconds,
+        which is estimated from the time measured in worker processes.
+    :param ordered: If True, outputs are ordered as the input elements. Otherwise, outputs are yielded as they are ready.
+    :param max_in_flight: The maximum number of chunks in flight. The default is `2 * num_processes`.
+
+    >>> tuple(imap_with_apply_async(abs, range(-5, 5), num_processes=2))
+    (5, 4, 3, 2, 1, 0, 1, 2, 3, 4)
+    >>> sorted(imap_with_apply_async(abs, range(-5, 5), num_processes=2, chunk_size=3, ordered=False))
+    [0, 1, 1, 2, 2, 3, 3, 4, 4, 5]
+    """
+
+    if max_in_flight is None:
+        max_in_flight = 2 * num_processes
+    assert max_in_flight > 0
+
+    adaptive = chunk_size is None
+    if adaptive:
+        chunk_size = 1
+        elem_time = None  # moving average of the time to process an element
+
+    iterator = iter(iterable)
+    result_q = queue.Queue()
+    num_sent_chunks = 0
+    num_in_flight = 0
+
+    def send_chunk(pool):
+        nonlocal num_sent_chunks, num_in_flight
+        chunk = tuple(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            return False
+        chunk_idx = num_sent_chunks
+        pool.apply_async(
+            _apply_to_chunk, args=(fn, chunk),
+            callback=lambda result: result_q.put((chunk_idx, True, result)),
+            error_callback=lambda exception: result_q.put((chunk_idx, False, exception)))
+        num_sent_chunks += 1
+        num_in_flight += 1
+        return True
+
     pool = mp.Pool(num_processes)
+    try:
+        while num_in_flight < max_in_flight and send_chunk(pool):
+            pass
 
-    async_results = []
-    for elem in iterable:
-        async_results.append(pool.apply_async(fn, args=(elem,)))
+        temp_dict = dict()
+        output_chunk_idx = 0
+        while num_in_flight > 0:
+            chunk_idx, succeeded, result = result_q.get()
+            num_in_flight -= 1
+            if not succeeded:
+                raise result
+            outputs, chunk_time = result
+
+            if adaptive and len(outputs) > 0:
+                new_elem_time = chunk_time / len(outputs)
+                elem_time = new_elem_time if elem_time is None else (elem_time + new_elem_time) / 2
+                # The chunk size grows at most twice at a time, since early measurements are noisy.
+                chunk_size = max(1, min(2 * chunk_size, max_chunk_size,
+                                        round(target_chunk_time / max(elem_time, 1e-9))))
+
+            send_chunk(pool)
+
+            if ordered:
+                temp_dict[chunk_idx] = outputs
+                while output_chunk_idx in temp_dict:
+                    yield from temp_dict.pop(output_chunk_idx)
+                    output_chunk_idx += 1
+            else:
+                yield from outputs
+    except BaseException:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
 
-    results = tuple(async_result.get() for async_result in async_results)
-    
-    pool.close()
-    pool.join()
 
-    return results
+def map_with_apply_async(fn, iterable, *, num_processes, chunk_size=None, mp=multiprocessing):
+    return tuple(imap_with_apply_async(fn, iterable, num_processes=num_processes, chunk_size=chunk_size, mp=mp))
 
 
 class ArgGroup:
@@ -59,62 +159,163 @@ class ArgGroup:
         return ArgGroup(*args, **kwargs)
 
 
-class Processor(metaclass=ABCMeta):
-    @classmethod
-    def map(cls, coll, arg_groups, mp=multiprocessing):
-        input_q = mp.Queue()
-        for elem_idx, elem in enumerate(coll):
-            input_q.put([elem_idx, elem])
-        coll_length = elem_idx + 1
-
-        output_q = mp.Queue()
-
-        processes = []
-        for processor_id, arg_group in enumerate(arg_groups):
-            process = mp.Process(
-                target=cls,
-                args=tuple(chain([processor_id, input_q, output_q], arg_group['args'])),
-                kwargs=arg_group['kwargs'])
-            process.start()
-            processes.append(process)
+class _SharedArrayDescriptor:
+    __slots__ = ('name', 'shape', 'dtype', 'is_tensor')
 
-        temp_dict = dict()
-        output_idx = 0
-        while output_idx < coll_length:
-            elem_idx, elem = output_q.get()
+    def __init__(self, name, shape, dtype, is_tensor):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+        self.is_tensor = is_tensor
 
-            if elem_idx == output_idx:
-                yield elem
-                output_idx += 1
-            else:
-                temp_dict[elem_idx] = elem
+    def __getstate__(self):
+        return (self.name, self.shape, self.dtype, self.is_tensor)
 
-            while output_idx in temp_dict:
-                yield temp_dict[output_idx]
-                del temp_dict[output_idx]
-                output_idx += 1
+    def __setstate__(self, state):
+        self.name, self.shape, self.dtype, self.is_tensor = state
 
-        assert output_q.empty()
 
-        for process in processes:
-            process.join()
+def _to_shared_array_descriptor(array, is_tensor):
+    shm = SharedMemory(create=True, size=array.nbytes)
+    shm_array = numpy.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+    shm_array[...] = array
+    del shm_array
+    # The block is unlinked by the receiver
+    shm.close()
+    return _SharedArrayDescriptor(shm.name, array.shape, array.dtype.str, is_tensor)
+
+
+def _from_shared_array_descriptor(descriptor):
+    shm = SharedMemory(name=descriptor.name)
+    # The memory is kept until the block is closed, even after the name is unlinked.
+    shm.unlink()
+    array = numpy.ndarray(descriptor.shape, dtype=numpy.dtype(descriptor.dtype), buffer=shm.buf)
+    # The array doesn't prevent the block from being closed, so the block is closed when the array is collected.
+    # (Views of the array and tensors from `torch.from_numpy` refer to the array.)
+    weakref.finalize(array, shm.close)
+    if descriptor.is_tensor:
+        import torch
+        return torch.from_numpy(array)
+    else:
+        return array
+
+
+def to_shared(obj, min_nbytes=0):
+    """
+    Replace NumPy arrays and CPU tensors in nested lists, tuples and dicts
+    with descriptors of shared memory blocks, to which the arrays are copied.
+    Arrays smaller than `min_nbytes` are not replaced.
+    """
 
-        # output = []
-        # while not output_q.empty():
-        #     output.append(output_q.get())
+    # torch is not imported unless it's already imported, since no tensor exists without it.
+    torch = sys.modules.get('torch')
 
-        # return output
+    def convert(obj):
+        obj_type = type(obj)
+        if obj_type in (list, tuple):
+            return obj_type(map(convert, obj))
+        elif obj_type is dict:
+            return {key: convert(value) for key, value in obj.items()}
+        elif 'numpy' in sys.modules and isinstance(obj, numpy.ndarray):
+            if obj.nbytes > 0 and obj.nbytes >= min_nbytes and not obj.dtype.hasobject:
+                return _to_shared_array_descriptor(obj, is_tensor=False)
+        elif torch is not None and isinstance(obj, torch.Tensor):
+            if obj.device.type == 'cpu' and not obj.requires_grad and obj.nbytes > 0 and obj.nbytes >= min_nbytes:
+                return _to_shared_array_descriptor(obj.numpy(), is_tensor=True)
+        return obj
+
+    return convert(obj)
+
+
+def from_shared(obj):
+    """
+    Replace descriptors made by `to_shared` with arrays (or tensors) that are views of shared memory blocks.
+    The names of the blocks are unlinked, so each descriptor should be converted only once.
+    """
+
+    def convert(obj):
+        obj_type = type(obj)
+        if obj_type in (list, tuple):
+            return obj_type(map(convert, obj))
+        elif obj_type is dict:
+            return {key: convert(value) for key, value in obj.items()}
+        elif obj_type is _SharedArrayDescriptor:
+            return _from_shared_array_descriptor(obj)
+        else:
+            return obj
+
+    return convert(obj)
+
+
+_DEFAULT_MIN_SHARED_NBYTES = 2 ** 16
+
+
+class SharedMemoryQueue:
+    """
+    A wrapper of a queue, which passes large arrays through shared memory blocks.
+    Only descriptors of the blocks are pickled, and a received array is a view of a block without copying.
+
+    :param queue: A queue such as `multiprocessing.Queue`.
+    :param min_nbytes: The minimum size (bytes) of an array that is passed through a shared memory block.
+    """
+
+    def __init__(self, queue, min_nbytes=_DEFAULT_MIN_SHARED_NBYTES):
+        self.queue = queue
+        self.min_nbytes = min_nbytes
+
+    def put(self, obj, *args, **kwargs):
+        self.queue.put(to_shared(obj, self.min_nbytes), *args, **kwargs)
+
+    def get(self, *args, **kwargs):
+        return from_shared(self.queue.get(*args, **kwargs))
+
+    def empty(self):
+        return self.queue.empty()
+
+
+class ProcessorError(Exception):
+    """
+    An exception that occurred in a processor, with the index of the element that caused it.
+    """
+
+    def __init__(self, elem_idx, message):
+        super().__init__(f'Processing the element at index {elem_idx} failed:\n{message}')
+        self.elem_idx = elem_idx
+        self.message = message
+
+
+class Processor(metaclass=ABCMeta):
+    @classmethod
+    def map(cls, coll, arg_groups, mp=multiprocessing, **kwargs):
+        '''
+        Apply `process` to elements with new processes, which are closed when all outputs are yielded.
+
+        :param kwargs: Options of `ProcessorPool` such as `shared_memory`, `timeout` and `max_retries`.
+        '''
+        with ProcessorPool(cls, arg_groups, mp=mp, **kwargs) as pool:
+            yield from pool.map(coll)
+
+    @classmethod
+    def pool(cls, arg_groups, **kwargs):
+        """
+        Return a `ProcessorPool` of persistent processors.
+        """
+        return ProcessorPool(cls, arg_groups, **kwargs)
 
     def __init__(self, processor_id, input_q, output_q, *init_args, **init_kwargs):
+        """
+        Process `[elem_idx, elem]` items of `input_q` until it's empty, and put `[elem_idx, output]` to `output_q`.
+
+        Processes of `map` and `pool` don't call `__init__`, so `initialize` is the only hook to set up a processor.
+        """
         self.id = processor_id
         self.initialize(*init_args, **init_kwargs)
 
-        # while not input_q.empty():
         while True:
             try:
                 elem_idx, elem = input_q.get_nowait()
                 output_q.put([elem_idx, self.process(elem)])
-            except Empty:
+            except queue.Empty:
                 break
 
     @abstractmethod
@@ -126,6 +327,586 @@ class Processor(metaclass=ABCMeta):
         pass
 
 
+def _run_pool_worker(processor_cls, processor_id, conn, init_args, init_kwargs, reporting_progress, min_shared_nbytes):
+    # `conn` is a pipe that is used only by this process, which receives a task (map_id, task_id, elems)
+    # at a time from the parent and sends back messages (kind, processor_id, map_id, task_id, offset, payload).
+    # A process that is killed while using its own pipe doesn't affect other processes.
+
+    def send(message):
+        conn.send(message if min_shared_nbytes is None else to_shared(message, min_shared_nbytes))
+
+    # The processor is created without `Processor.__init__`, which consumes a queue of the old protocol.
+    processor = processor_cls.__new__(processor_cls)
+    processor.id = processor_id
+    try:
+        processor.initialize(*init_args, **init_kwargs)
+    except Exception:
+        send(('init_error', processor_id, None, None, None, traceback.format_exc()))
+        return
+
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        map_id, task_id, elems = task if min_shared_nbytes is None else from_shared(task)
+        outputs = []
+        for offset, elem in enumerate(elems):
+            if reporting_progress and offset > 0:
+                send(('progress', processor_id, map_id, task_id, offset, None))
+            try:
+                outputs.append(processor.process(elem))
+            except Exception:
+                send(('error', processor_id, map_id, task_id, offset, (outputs, traceback.format_exc())))
+                break
+        else:
+            send(('done', processor_id, map_id, task_id, None, outputs))
+
+
+class ProcessorPoolStats:
+    """
+    Busy time and the number of processed elements of each processor,
+    which are measured in the parent process from messages of processors.
+    """
+
+    def __init__(self, num_processors):
+        self.busy_times = [0.0] * num_processors
+        self.nums_elems = [0] * num_processors
+        self.wall_time = 0.0
+
+    @property
+    def utilizations(self):
+        return [(busy_time / self.wall_time if self.wall_time > 0 else 0.0) for busy_time in self.busy_times]
+
+    def __repr__(self):
+        return 'ProcessorPoolStats(wall_time={:.3f}s, utilizations=[{}], nums_elems={})'.format(
+            self.wall_time, ', '.join(f'{utilization:.2f}' for utilization in self.utilizations), self.nums_elems)
+
+    def report(self):
+        lines = [f'wall time: {self.wall_time:.3f}s']
+        for processor_id, (busy_time, num_elems, utilization) in enumerate(
+                zip(self.busy_times, self.nums_elems, self.utilizations)):
+            lines.append(f'processor {processor_id}: busy time = {busy_time:.3f}s, '
+                         f'utilization = {utilization:.1%}, elements = {num_elems}')
+        return '\n'.join(lines)
+
+
+def _iter_indexed_chunks(coll, chunk_size, cost_fn):
+    # Each chunk is a pair of element indices and elements.
+    if cost_fn is None:
+        num_read_elems = 0
+        for chunk in partition(coll, chunk_size, strict=False):
+            yield range(num_read_elems, num_read_elems + len(chunk)), chunk
+            num_read_elems += len(chunk)
+    else:
+        # Longest processing time first:
+        # costly elements are sent first so that cheap elements fill the gaps at the end.
+        elems = tuple(coll)
+        costs = tuple(map(cost_fn, elems))
+        sorted_indices = sorted(range(len(elems)), key=costs.__getitem__, reverse=True)
+        for elem_indices in partition(sorted_indices, chunk_size, strict=False):
+            yield elem_indices, tuple(elems[elem_idx] for elem_idx in elem_indices)
+
+
+class ProcessorPool:
+    """
+    A pool of persistent processes, each of which has a `Processor` object.
+    `Processor.initialize` is called once for each process, and the pool can be reused for many `map` calls.
+
+    Elements are sent in chunks, and the number of chunks that are sent but not returned is bounded,
+    so a long (or infinite) iterable is not consumed much ahead of the outputs.
+
+    A process that exits unexpectedly, or that spends more than `timeout` seconds on an element, is restarted.
+    An element that raises an exception or causes a restart is retried up to `max_retries` times.
+    After that, a `ProcessorError` with the index of the element is raised,
+    or it is yielded in place of the output when `raising` is False.
+
+    A task is sent to a processor only when the processor is idle, so a processor is not blocked
+    behind tasks assigned to another processor. When costs of elements are uneven,
+    `cost_fn` of `map` can be given to send costly elements first.
+    The busy time of each processor is accumulated in `stats`, which is a `ProcessorPoolStats` object.
+
+    :param processor_cls: A subclass of `Processor`.
+    :param arg_groups: `ArgGroup` objects for `Processor.initialize`. The number of processes is `len(arg_groups)`.
+    :param chunk_size: The number of elements in a task.
+    :param max_in_flight: The maximum number of chunks in flight. The default is `2 * len(arg_groups)`.
+    :param shared_memory: If True, large arrays in inputs and outputs are passed through shared memory blocks.
+        It can also be the minimum size (bytes) of an array to be passed through a shared memory block.
+    :param timeout: The maximum time (seconds) to process an element. None means no limit.
+    :param max_retries: The maximum number of retries for an element.
+    :param raising: If False, a `ProcessorError` is yielded rather than raised.
+    :param polling_interval: The interval (seconds) to check processes.
+
+    >>> with ExampleProcessor.pool([ArgGroup(fn=lambda x: x * x, sleep_time=0.01)] * 4, chunk_size=3) as pool:
+    ...     print(list(pool.map(range(20))))
+    ...     print(list(pool.map(range(5))))
+    [0, 1, 4, 9, 16, 25, 36, 49, 64, 81, 100, 121, 144, 169, 196, 225, 256, 289, 324, 361]
+    [0, 1, 4, 9, 16]
+
+    Tasks of a map stopped before the end are not processed by the next map.
+
+    >>> with ExampleProcessor.pool([ArgGroup(fn=lambda x: x, sleep_time=0.1)] * 2, max_in_flight=20) as pool:
+    ...     print(next(pool.map(range(20))))
+    ...     start_time = time.monotonic()
+    ...     print(list(pool.map(range(2))), time.monotonic() - start_time < 0.5)
+    0
+    [0, 1] True
+
+    >>> import numpy
+    >>> arrays = [numpy.full([256, 256], idx) for idx in range(4)]
+    >>> with ExampleProcessor.pool([ArgGroup(fn=lambda x: x * 2, sleep_time=0)] * 2, shared_memory=True) as pool:
+    ...     print([int(output[0, 0]) for output in pool.map(arrays)])
+    [0, 2, 4, 6]
+
+    >>> import time
+    >>> def fn(x):
+    ...     if x == 2:
+    ...         time.sleep(10)  # hanging
+    ...     return 10 // (x - 4)
+    >>> with ExampleProcessor.pool([ArgGroup(fn=fn, sleep_time=0)] * 2, timeout=1, raising=False) as pool:
+    ...     for output in pool.map(range(6)):
+    ...         print(repr(output) if not isinstance(output, ProcessorError) else f'error at {output.elem_idx}')
+    -3
+    -4
+    error at 2
+    -10
+    error at 4
+    10
+
+    A process that exits abruptly (e.g. by a segmentation fault) doesn't stall the other processes.
+
+    >>> import os
+    >>> def crash(x):
+    ...     if x == 3:
+    ...         os._exit(1)
+    ...     return x
+    >>> with ExampleProcessor.pool([ArgGroup(fn=crash, sleep_time=0)] * 2, raising=False) as pool:
+    ...     print([(output if not isinstance(output, ProcessorError) else 'error') for output in pool.map(range(6))])
+    [0, 1, 2, 'error', 4, 5]
+
+    Many short timeouts don't lose any element.
+
+    >>> import random
+    >>> def sleep_randomly(x):
+    ...     time.sleep(random.uniform(0.008, 0.012))
+    ...     return x
+    >>> with ExampleProcessor.pool([ArgGroup(fn=sleep_randomly, sleep_time=0)] * 4,
+    ...                            timeout=0.01, polling_interval=0.001, raising=False) as pool:
+    ...     for _ in range(10):
+    ...         outputs = list(pool.map(range(20)))
+    ...         assert [(output.elem_idx if isinstance(output, ProcessorError) else output)
+    ...                 for output in outputs] == list(range(20))
+
+    >>> with ExampleProcessor.pool([ArgGroup(fn=lambda x: x, sleep_time=0.01)] * 2, chunk_size=2) as pool:
+    ...     print(list(pool.map(['a', 'bbb', 'cc', 'dddd'], cost_fn=len)))
+    ...     print(sum(pool.stats.nums_elems))
+    ['a', 'bbb', 'cc', 'dddd']
+    4
+    """
+
+    def __init__(self, processor_cls, arg_groups, *, chunk_size=1, max_in_flight=None, mp=multiprocessing,
+                 shared_memory=False, timeout=None, max_retries=0, raising=True, polling_interval=0.1):
+        assert chunk_size > 0
+        self.processor_cls = processor_cls
+        self.arg_groups = tuple(arg_groups)
+        self.chunk_size = chunk_size
+        self.max_in_flight = 2 * len(self.arg_groups) if max_in_flight is None else max_in_flight
+        assert self.max_in_flight > 0
+        self.mp = mp
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.raising = raising
+        self.polling_interval = polling_interval
+
+        if shared_memory is False:
+            self.min_shared_nbytes = None
+        else:
+            # Child processes should share the resource tracker of the parent process,
+            # since a block can be registered by a process and unlinked by another process.
+            resource_tracker.ensure_running()
+            self.min_shared_nbytes = _DEFAULT_MIN_SHARED_NBYTES if shared_memory is True else shared_memory
+        self.processes = [None] * len(self.arg_groups)
+        # The parent's ends of pipes to processes
+        self.conns = [None] * len(self.arg_groups)
+        # Each state is None for an idle process,
+        # or [map_id, task_id, offset, start time of the element, start time of the task] for a busy process
+        self.worker_states = [None] * len(self.arg_groups)
+        self.stats = ProcessorPoolStats(len(self.arg_groups))
+        for processor_id in range(len(self.arg_groups)):
+            self._start_worker(processor_id)
+
+        self.num_maps = 0
+        self.num_restarts = 0
+        self.closed = False
+
+    def _start_worker(self, processor_id):
+        arg_group = self.arg_groups[processor_id]
+        parent_conn, child_conn = self.mp.Pipe()
+        process = self.mp.Process(
+            target=_run_pool_worker,
+            args=(self.processor_cls, processor_id, child_conn, arg_group['args'], arg_group['kwargs'],
+                  self.timeout is not None, self.min_shared_nbytes),
+            daemon=True)
+        process.start()
+        # The parent doesn't keep the child's end, so `recv` raises EOFError when the process is dead.
+        child_conn.close()
+        self.processes[processor_id] = process
+        self.conns[processor_id] = parent_conn
+        self.worker_states[processor_id] = None
+
+    def _send(self, processor_id, task):
+        self.conns[processor_id].send(task if self.min_shared_nbytes is None else
+                                      to_shared(task, self.min_shared_nbytes))
+
+    def _receive(self, processor_id):
+        message = self.conns[processor_id].recv()
+        return message if self.min_shared_nbytes is None else from_shared(message)
+
+    def _restart_worker(self, processor_id):
+        process = self.processes[processor_id]
+        if process.is_alive():
+            process.terminate()
+        process.join()
+        # A message that is partially written by the dead process is discarded with the pipe.
+        self.conns[processor_id].close()
+        self.num_restarts += 1
+        self._start_worker(processor_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, except_type, except_value, except_traceback):
+        if except_type is None:
+            self.close()
+        else:
+            # Processes may be still working on elements that are not needed
+            self.terminate()
+
+    def map(self, coll, cost_fn=None):
+        """
+        Return a generator of outputs, which are ordered as the input elements.
+
+        :param cost_fn: A function that estimates the cost of an element, like `size_fn` of `slice_by_max_size`.
+            When it's given, all elements are read first, and they are sent in decreasing order of the costs.
+        """
+
+        assert not self.closed
+        self.num_maps += 1
+        # Messages of a previous map that is stopped before the end are distinguished by `map_id`.
+        map_id = self.num_maps
+
+        chunk_iter = _iter_indexed_chunks(coll, self.chunk_size, cost_fn)
+        num_tasks = 0
+        tasks = dict()  # task_id -> (element indices, elements) of a pending or running task
+        pending_task_ids = deque()
+        num_failures = dict()  # element index -> the number of failures
+        outputs = dict()  # element index -> output
+        output_idx = 0
+
+        def send_task(elem_indices, elems):
+            nonlocal num_tasks
+            if len(elems) > 0:
+                task_id = num_tasks
+                num_tasks += 1
+                tasks[task_id] = (elem_indices, elems)
+                pending_task_ids.append(task_id)
+
+        def send_next_chunk():
+            for elem_indices, chunk in chunk_iter:
+                send_task(elem_indices, chunk)
+                return True
+            return False
+
+        def assign_tasks():
+            for processor_id, state in enumerate(self.worker_states):
+                if len(pending_task_ids) == 0:
+                    break
+                if state is None:
+                    task_id = pending_task_ids.popleft()
+                    now = time.monotonic()
+                    self.worker_states[processor_id] = [map_id, task_id, 0, now, now]
+                    try:
+                        self._send(processor_id, (map_id, task_id, tasks[task_id][1]))
+                    except OSError:
+                        # The process is dead, so the task is assigned again after the process is restarted.
+                        self.worker_states[processor_id] = None
+                        pending_task_ids.appendleft(task_id)
+
+        def fail(task_id, offset, done_outputs, message):
+            elem_indices, elems = tasks.pop(task_id)
+            for elem_idx, output in zip(elem_indices, done_outputs):
+                outputs[elem_idx] = output
+            if offset is None:
+                if len(elems) == 1:
+                    offset = 0
+                else:
+                    # The failed element is unknown, so the elements are retried one by one to isolate it.
+                    for elem_idx, elem in zip(elem_indices, elems):
+                        send_task((elem_idx,), (elem,))
+                    return
+
+            # Outputs of the elements before the failed element are lost when the process is restarted.
+            send_task(elem_indices[len(done_outputs):offset], elems[len(done_outputs):offset])
+
+            elem_idx = elem_indices[offset]
+            num_failures[elem_idx] = num_failures.get(elem_idx, 0) + 1
+            if num_failures[elem_idx] > self.max_retries:
+                error = ProcessorError(elem_idx, message)
+                if self.raising:
+                    raise error
+                outputs[elem_idx] = error
+                send_task(elem_indices[offset + 1:], elems[offset + 1:])
+            else:
+                send_task(elem_indices[offset:], elems[offset:])
+
+        def handle(message):
+            kind, processor_id, message_map_id, task_id, offset, payload = message
+            if kind == 'init_error':
+                raise ProcessorError(None, payload)
+            # A message is always about the task that is assigned to the process.
+            state = self.worker_states[processor_id]
+            if kind == 'progress':
+                state[2:4] = [offset, time.monotonic()]
+                return
+
+            self.worker_states[processor_id] = None
+            # A task of a previous map that is stopped before the end is not counted in `stats`.
+            if message_map_id == map_id:
+                self.stats.busy_times[processor_id] += time.monotonic() - state[4]
+                self.stats.nums_elems[processor_id] += len(payload) if kind == 'done' else offset + 1
+            if message_map_id == map_id and task_id in tasks:
+                if kind == 'done':
+                    elem_indices, elems = tasks.pop(task_id)
+                    for elem_idx, output in zip(elem_indices, payload):
+                        outputs[elem_idx] = output
+                else:
+                    done_outputs, traceback_text = payload
+                    fail(task_id, offset, done_outputs, traceback_text)
+
+        def receive_all(processor_id):
+            """
+            Handle all messages that are ready from a process.
+            :returns: False if the pipe is closed by the process
+            """
+            conn = self.conns[processor_id]
+            try:
+                while conn.poll():
+                    handle(self._receive(processor_id))
+            except (EOFError, OSError):
+                return False
+            return True
+
+        def check_workers():
+            for processor_id, process in enumerate(self.processes):
+                alive = process.is_alive()
+                # Messages that are sent before the check are handled first,
+                # so a task that is already finished is not regarded as running.
+                receive_all(processor_id)
+                state = self.worker_states[processor_id]
+                now = time.monotonic()
+                if not alive:
+                    message = f'The process of the processor {processor_id} exited with code {process.exitcode}.'
+                elif self.timeout is not None and state is not None and now - state[3] > self.timeout:
+                    message = f'The processor {processor_id} exceeded the timeout of {self.timeout} seconds.'
+                else:
+                    continue
+                self._restart_worker(processor_id)
+                if state is not None:
+                    state_map_id, task_id, offset, _, _ = state
+                    if state_map_id == map_id:
+                        self.stats.busy_times[processor_id] += now - state[4]
+                    if state_map_id == map_id and task_id in tasks:
+                        fail(task_id, offset if self.timeout is not None else None, (), message)
+
+        map_start_time = last_check_time = time.monotonic()
+        while len(tasks) < self.max_in_flight and send_next_chunk():
+            pass
+        assign_tasks()
+
+        try:
+            while len(tasks) > 0:
+                ready_conns = multiprocessing.connection.wait(self.conns, timeout=self.polling_interval)
+                all_open = True
+                for conn in ready_conns:
+                    # All ready messages are handled before checking timeouts,
+                    # since messages can be delayed while the caller doesn't consume outputs.
+                    all_open = receive_all(self.conns.index(conn)) and all_open
+
+                if not ready_conns or not all_open or time.monotonic() - last_check_time > self.polling_interval:
+                    check_workers()
+                    last_check_time = time.monotonic()
+
+                while len(tasks) < self.max_in_flight and send_next_chunk():
+                    pass
+                assign_tasks()
+
+                while output_idx in outputs:
+                    yield outputs.pop(output_idx)
+                    output_idx += 1
+        finally:
+            # The wall time is added also when the map is stopped before the end
+            self.stats.wall_time += time.monotonic() - map_start_time
+
+    def close(self):
+        if not self.closed:
+            for processor_id, process in enumerate(self.processes):
+                if self.worker_states[processor_id] is None:
+                    try:
+                        self.conns[processor_id].send(None)
+                    except OSError:
+                        pass
+                else:
+                    # The process is still working on a task of a map stopped before the end,
+                    # and its output is not received.
+                    process.terminate()
+            for process in self.processes:
+                process.join()
+            for conn in self.conns:
+                conn.close()
+            self.closed = True
+
+    def terminate(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+        for conn in self.conns:
+            conn.close()
+        self.closed = True
+
+
+def _start_progress(iterable, progress):
+    # Each `next` on the returned iterator reports that an output is made.
+    if not progress:
+        return None
+    from .iteration import xtqdm
+
+    tqdm_kwargs = progress if isinstance(progress, dict) else {}
+    if 'total' not in tqdm_kwargs:
+        try:
+            tqdm_kwargs = dict(tqdm_kwargs, total=len(iterable))
+        except TypeError:
+            pass
+    progress_iter = xtqdm(itertools.count(), **tqdm_kwargs)
+    next(progress_iter)
+    return progress_iter
+
+
+async def amap(fn, iterable, *, concurrency, arg_group=None, ordered=True, progress=False):
+    """
+    Return an async generator that applies a coroutine function `fn` to elements of `iterable`,
+    while at most `concurrency` calls are running at a time.
+
+    :param fn: A coroutine function that is called as `fn(elem, *arg_group.args, **arg_group.kwargs)`.
+    :param iterable: An iterable or an async iterable.
+    :param arg_group: An `ArgGroup` object of additional arguments for `fn`.
+    :param ordered: If True, outputs are ordered as the input elements. Otherwise, outputs are yielded as they are ready.
+    :param progress: If True, the progress is shown by `iteration.xtqdm`. It can also be a dict of arguments for tqdm.
+
+    >>> import asyncio
+    >>> async def delayed_add(x, y, delay):
+    ...     await asyncio.sleep(delay * (5 - x))
+    ...     return x + y
+    >>> async def main():
+    ...     return [output async for output in amap(delayed_add, range(5), concurrency=3,
+    ...                                             arg_group=ArgGroup(10, delay=0.01))]
+    >>> asyncio.run(main())
+    [10, 11, 12, 13, 14]
+    """
+
+    assert concurrency > 0
+    if arg_group is None:
+        arg_group = ArgGroup()
+
+    if hasattr(iterable, '__aiter__'):
+        async_iterator = iterable.__aiter__()
+    else:
+        async_iterator = None
+        iterator = iter(iterable)
+
+    async def get_next_elem():
+        if async_iterator is None:
+            return next(iterator, NO_VALUE)
+        else:
+            try:
+                return await async_iterator.__anext__()
+            except StopAsyncIteration:
+                return NO_VALUE
+
+    progress_iter = _start_progress(iterable, progress)
+    task_to_idx = dict()
+    temp_dict = dict()
+    num_read_elems = 0
+    output_idx = 0
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and len(task_to_idx) < concurrency:
+                elem = await get_next_elem()
+                if elem is NO_VALUE:
+                    exhausted = True
+                else:
+                    task = asyncio.ensure_future(fn(elem, *arg_group.args, **arg_group.kwargs))
+                    task_to_idx[task] = num_read_elems
+                    num_read_elems += 1
+            if len(task_to_idx) == 0:
+                break
+
+            done_tasks, _ = await asyncio.wait(tuple(task_to_idx), return_when=asyncio.FIRST_COMPLETED)
+            for task in sorted(done_tasks, key=task_to_idx.get):
+                elem_idx = task_to_idx.pop(task)
+                output = task.result()
+                if progress_iter is not None:
+                    next(progress_iter)
+                if ordered:
+                    temp_dict[elem_idx] = output
+                else:
+                    yield output
+            while output_idx in temp_dict:
+                yield temp_dict.pop(output_idx)
+                output_idx += 1
+    finally:
+        for task in task_to_idx:
+            task.cancel()
+        if progress_iter is not None:
+            progress_iter.close()
+
+
+async def athread_map(fn, iterable, *, num_threads, arg_group=None, ordered=True, progress=False):
+    """
+    Return an async generator that applies a normal function `fn` to elements of `iterable` with a thread pool.
+    It's suitable for I/O-bound functions such as reading files.
+
+    The parameters are same as those of `amap`, except that `num_threads` determines the concurrency.
+
+    >>> import asyncio
+    >>> async def main():
+    ...     return [output async for output in athread_map(pow, range(5), num_threads=2, arg_group=ArgGroup(2))]
+    >>> asyncio.run(main())
+    [0, 1, 4, 9, 16]
+    """
+
+    if arg_group is None:
+        arg_group = ArgGroup()
+
+    executor = concurrent.futures.ThreadPoolExecutor(num_threads)
+    loop = asyncio.get_running_loop()
+
+    async def run_in_thread(elem):
+        return await loop.run_in_executor(
+            executor, functools.partial(fn, elem, *arg_group.args, **arg_group.kwargs))
+
+    try:
+        async for output in amap(run_in_thread, iterable, concurrency=num_threads,
+                                 ordered=ordered, progress=progress):
+            yield output
+    finally:
+        # The event loop is not blocked by threads that are still running
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
 class ExampleProcessor(Processor):
     """
     >>> num_processes = 4
@@ -1,6 +1,7 @@
 
 import re
 import warnings
+import weakref
 from argparse import Namespace
 from enum import Enum, auto as enum_auto
 from itertools import chain
@@ -8,7 +9,6 @@ from itertools import chain
 from .iteration import distinct_pairs
 from .exception import DuplicateValueError
 from .lazy import LazyEval, eval_lazy_obj, get_eval_obj_unless_lazy
-from .decoration import id_cache
 from .constant import NO_VALUE
 from .text import camel_to_symbol
 
@@ -69,6 +69,9 @@ class XNamespace(Namespace):
     1
     """
 
+    # `_popper` is kept out of `__dict__`, which holds the content of the namespace
+    __slots__ = ('_popper',)
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
@@ -78,10 +81,17 @@ class XNamespace(Namespace):
     def __len__(self):
         return len(self.__dict__)
 
+    def __getstate__(self):
+        # The cached popper is not copied
+        return self.__dict__
+
     @property
-    @id_cache
     def popper(self):
-        return AttrPopper(self)
+        try:
+            return self._popper
+        except AttributeError:
+            self._popper = AttrPopper(self)
+            return self._popper
 
     def pop(self, key=NO_VALUE, popping=True, **kwargs):
         if key is NO_VALUE:
@@ -140,26 +150,64 @@ class LazyDict(dict):
 
 
 class TreeStructure:
+    '''
+    A partial tree that is built incrementally by pushing nodes and reducing opened nodes.
+    Each object is a node in a chain of `prev` links, which is shared with previous trees.
+
+    Each node caches the nearest opened node in the chain, the number of opened nodes and the number of nodes,
+    so finding an opened tree, rendering and counting don't walk the whole chain recursively.
+
+    Example:
+
+    >>> tree = TreeStructure.create_root('root')
+    >>> tree = tree.push_nonterm('add').push_term(1).push_term(2).reduce()
+    >>> tree = tree.push_term(3)
+    >>> tree
+    (root (add 1 2) 3}
+    >>> tree.count_nodes()
+    5
+    >>> tree.get_all_values()
+    ['root', 'add', 1, 2, 3]
+    >>> tree = tree.reduce()
+    >>> tree
+    (root (add 1 2) 3)
+    >>> tree.is_closed_root()
+    True
+    '''
+
+    __slots__ = ('value', 'terminal', 'prev', 'opened', 'children',
+                 'opened_tree', 'num_opened_trees', 'num_sub_tree_nodes', 'num_nodes', '__weakref__')
+
     @classmethod
     def create_root(cls, value, terminal=False):
-        struct = cls(value, terminal, None)
-        struct.opened = not terminal
-        return struct
+        return cls._make_node(value, terminal, None, not terminal, ())
 
-    def __init__(self, value, terminal, prev):
+    @classmethod
+    def _make_node(cls, value, terminal, prev, opened, children):
+        # Every node is made by this method except when the constructor is called directly.
+        return cls(value, terminal, prev, opened, children)
+
+    def __init__(self, value, terminal, prev, opened=None, children=()):
         self.value = value
         self.terminal = terminal
         self.prev = prev
+        self.opened = (not terminal) if opened is None else opened
+        self.children = children
+
+        if self.is_opened():
+            self.opened_tree = self
+        else:
+            self.opened_tree = None if prev is None else prev.opened_tree
+        self.num_opened_trees = (0 if prev is None else prev.num_opened_trees) + (1 if self.is_opened() else 0)
+        self.num_sub_tree_nodes = 1 + sum(child.num_sub_tree_nodes for child in children)
+        self.num_nodes = self.num_sub_tree_nodes + (0 if prev is None else prev.num_nodes)
 
     def __repr__(self):
         lisp_style = True
         enable_prev = True
 
-        num_reduces = 0
-        tree = self
-        while not tree.is_closed_root():
-            num_reduces += 1
-            tree = tree.reduce()
+        # The number of reduces until the tree becomes a closed root
+        num_reduces = self.num_opened_trees
 
         representation = self.repr_opened(
             lisp_style=lisp_style, enable_prev=enable_prev)
@@ -167,30 +215,49 @@ class TreeStructure:
         # 'representation' may have a trailing whitespace char, so '.strip' is used
         return representation.strip() + "}" * num_reduces
 
-    def repr_opened(self, lisp_style, enable_prev, symbol_repr=False):
-        representation = str(self.value)  # or repr_opened(self.value)
-        if symbol_repr:
-            representation = camel_to_symbol(representation)
-        if not self.terminal:
-            representation = '(' + representation + ' ' if lisp_style else \
-                             representation + '('
-            if not self.opened:
-                delimiter = ' ' if lisp_style else ', '
-                representation = representation + \
-                    delimiter.join(child.repr_opened(lisp_style=lisp_style, enable_prev=False)
-                                   for child in self.children) + ')'
-        if self.prev and enable_prev:
-            if self.prev.is_closed():
-                delimiter = ' ' if lisp_style else ', '
-                representation = '{}{}{}'. format(
-                    self.prev.repr_opened(lisp_style=lisp_style, enable_prev=True),
-                    delimiter, representation)
+    def _extend_repr_pieces(self, pieces, lisp_style, symbol_repr):
+        # Render the sub-tree without 'prev', by a stack rather than recursion
+        delimiter = ' ' if lisp_style else ', '
+        stack = [self]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, str):
+                pieces.append(item)
+                continue
+
+            representation = str(item.value)
+            if symbol_repr and item is self:
+                representation = camel_to_symbol(representation)
+            if item.terminal:
+                pieces.append(representation)
             else:
-                representation = '{}{}'. format(
-                    self.prev.repr_opened(lisp_style=lisp_style, enable_prev=True),
-                    representation)
+                pieces.append('(' + representation + ' ' if lisp_style else representation + '(')
+                if not item.opened:
+                    stack.append(')')
+                    for idx in reversed(range(len(item.children))):
+                        stack.append(item.children[idx])
+                        if idx > 0:
+                            stack.append(delimiter)
 
-        return representation
+    def repr_opened(self, lisp_style, enable_prev, symbol_repr=False):
+        delimiter = ' ' if lisp_style else ', '
+        if enable_prev:
+            chain_nodes = []
+            tree = self
+            while tree is not None:
+                chain_nodes.append(tree)
+                tree = tree.prev
+            chain_nodes.reverse()
+        else:
+            chain_nodes = [self]
+
+        pieces = []
+        for idx, tree in enumerate(chain_nodes):
+            if idx > 0 and chain_nodes[idx - 1].is_closed():
+                pieces.append(delimiter)
+            tree._extend_repr_pieces(pieces, lisp_style, symbol_repr and tree is self)
+
+        return ''.join(pieces)
 
     def is_opened(self):
         return not self.terminal and self.opened
@@ -199,12 +266,10 @@ class TreeStructure:
         return self.terminal or not self.opened
 
     def push_term(self, value):
-        return self.__class__(value, True, self)
+        return self._make_node(value, True, self, False, ())
 
     def push_nonterm(self, value):
-        tree = self.__class__(value, False, self)
-        tree.opened = True
-        return tree
+        return self._make_node(value, False, self, True, ())
 
     def reduce(self, value=None):
         opened_tree, children = self.get_opened_tree_children()
@@ -214,27 +279,27 @@ class TreeStructure:
         if value is None:
             value = self.value
 
-        new_tree = self.__class__(value, False, self.prev)
-        new_tree.opened = False
-        new_tree.children = children
-
-        return new_tree
+        return self._make_node(value, False, self.prev, False, children)
 
     def get_parent_siblings(self):
+        parent = self.prev.opened_tree
+        siblings = []
         tree = self.prev  # starts from prev
-        reversed_siblings = []
-        while tree.is_closed():
-            reversed_siblings.append(tree)
+        while tree is not parent:
+            siblings.append(tree)
             tree = tree.prev
-        return tree, tuple(reversed(reversed_siblings))
+        siblings.reverse()
+        return parent, tuple(siblings)
 
     def get_opened_tree_children(self):
+        opened_tree = self.opened_tree
+        children = []
         tree = self  # starts from self
-        reversed_children = []
-        while tree.is_closed():
-            reversed_children.append(tree)
+        while tree is not opened_tree:
+            children.append(tree)
             tree = tree.prev
-        return tree, tuple(reversed(reversed_children))
+        children.reverse()
+        return opened_tree, tuple(children)
 
     def is_root(self):
         return self.prev is None
@@ -256,10 +321,12 @@ class TreeStructure:
         return values  # values don't include it's parent
 
     def _construct_values(self, values):
-        values.append(self.value)
-        if not self.terminal:
-            for child in self.children:
-                child._construct_values(values)
+        stack = [self]
+        while stack:
+            tree = stack.pop()
+            values.append(tree.value)
+            if not tree.terminal:
+                stack.extend(reversed(tree.children))
 
     def get_all_values(self):
         def get_values(tree):
@@ -268,17 +335,19 @@ class TreeStructure:
             else:
                 return [tree.value]
 
-        all_values = []
-
-        def recurse(tree):
-            if not tree.is_root():
-                parent, siblings = tree.get_parent_siblings()
-                recurse(parent)
-                for sibling in siblings:
-                    all_values.extend(get_values(sibling))
+        # Pairs of siblings and a tree from the bottom of the chain
+        levels = []
+        tree = self
+        while not tree.is_root():
+            parent, siblings = tree.get_parent_siblings()
+            levels.append((siblings, tree))
+            tree = parent
+
+        all_values = get_values(tree)
+        for siblings, tree in reversed(levels):
+            for sibling in siblings:
+                all_values.extend(get_values(sibling))
             all_values.extend(get_values(tree))
-
-        recurse(self)
         return all_values
 
     def get_value_tree(self):
@@ -292,19 +361,13 @@ class TreeStructure:
         return recurse(self)
 
     def count_nodes(self, enable_prev=True):
-        count = 1
-        if enable_prev and self.prev:
-            count += self.prev.count_nodes()
-        if not self.terminal and not self.opened:
-            for child in self.children:
-                count += child.count_nodes(False)
-        return count
+        return self.num_nodes if enable_prev else self.num_sub_tree_nodes
 
     def get_last_value(self):
-        if self.terminal or self.opened:
-            return self.value
-        else:
-            return self.children[-1].get_last_value()
+        tree = self
+        while not (tree.terminal or tree.opened):
+            tree = tree.children[-1]
+        return tree.value
 
     def find_sub_tree(self, item, key=lambda x: x.value):
         # don't consider 'prev'
@@ -321,6 +384,53 @@ class TreeStructure:
                 return None
 
 
+class InternedTreeStructure(TreeStructure):
+    '''
+    A `TreeStructure` whose nodes are hash-consed.
+    Pushing the same value onto the same node returns the same object, so hypotheses of beam search
+    share nodes of their common prefixes, and the memory scales with the number of distinct prefixes.
+    Equal trees are identical objects, so `==` (identity) compares two trees in O(1).
+
+    Interned nodes are kept in a `weakref.WeakValueDictionary`, so a node is released when it's not used.
+    A value that is not hashable is not interned.
+
+    Example:
+
+    >>> beam_1 = InternedTreeStructure.create_root('root').push_nonterm('add').push_term(1)
+    >>> beam_2 = InternedTreeStructure.create_root('root').push_nonterm('add').push_term(1)
+    >>> beam_1 is beam_2
+    True
+    >>> beam_1.push_term(2).reduce() == beam_2.push_term(2).reduce()
+    True
+    >>> beam_1.push_term(2) == beam_2.push_term(3)
+    False
+    >>> beam_1.push_term(2).prev is beam_2.push_term(3).prev
+    True
+    '''
+
+    __slots__ = ()
+
+    _interned_nodes = weakref.WeakValueDictionary()
+
+    @classmethod
+    def _make_node(cls, value, terminal, prev, opened, children):
+        # Nodes are compared by identity, so `prev` and `children` are identified by the objects themselves.
+        # The type of `value` is included, since e.g. `1 == True`.
+        key = (type(value), value, terminal, opened, prev, children)
+        try:
+            node = cls._interned_nodes.get(key)
+        except TypeError:
+            # `value` is not hashable
+            return cls(value, terminal, prev, opened, children)
+        if node is None:
+            node = cls._interned_nodes.setdefault(key, cls(value, terminal, prev, opened, children))
+        return node
+
+    @classmethod
+    def count_interned_nodes(cls):
+        return len(cls._interned_nodes)
+
+
 class bidict(dict):
     '''
     Bidirectional dictionary
@@ -7,6 +7,7 @@ from torch.utils.data.sampler import Sampler
 from ..klass import subclass, implement
 from ..iteration import iterate, slice_by_max_size
 from ..hflib.acceleration import Acceleratable
+from ..filesys import LineIndex, JsonlIndex
 
 
 class SimpleDataset(torch.utils.data.Dataset):
@@ -20,6 +21,16 @@ class SimpleDataset(torch.utils.data.Dataset):
         return len(self.examples)
 
 
+class LineDataset(SimpleDataset):
+    '''
+    Dataset of lines in a text file or objects in a JSON Lines file.
+    Unlike `SimpleDataset`, examples are not loaded into memory, but they are read through `filesys.LineIndex`.
+    '''
+
+    def __init__(self, path, jsonl=False, **kwargs):
+        super().__init__((JsonlIndex if jsonl else LineIndex)(path, **kwargs))
+
+
 @subclass
 class EpochRepeatingDataLoader(Acceleratable):
     '''
@@ -25,3 +25,75 @@ def get_perturbed_log_probs(parent_perturbed_log_prob, child_log_probs):
     perturbed_log_probs = T - F.relu(u) - torch.log1p(torch.exp(-u.abs()))
 
     return perturbed_log_probs, gumbels
+
+
+def sample_gumbels(size, generator=None, device=None, dtype=torch.float, out=None):
+    '''
+    Sample Gumbel noises in-place.
+
+    :param generator: a `torch.Generator` object for sampling
+    :param out: a preallocated tensor to be filled. When `out` is given, `size`, `device` and `dtype` are ignored.
+    '''
+
+    if out is None:
+        out = torch.empty(size, device=device, dtype=dtype)
+
+    # -log(u) ~ Exponential(1) where u ~ Uniform(0, 1)
+    # F^-1(u) = -log(-log(u))
+    return out.exponential_(generator=generator).log_().neg_()
+
+
+def get_batched_perturbed_log_probs(parent_perturbed_log_probs, child_log_probs, generator=None, gumbels_out=None):
+    '''
+    Batched version of `get_perturbed_log_probs`.
+
+    :param parent_perturbed_log_probs: a tensor of shape [num_parents]
+    :param child_log_probs: a tensor of shape [num_parents, num_children]
+    :param generator: a `torch.Generator` object for sampling Gumbel noises
+    :param gumbels_out: a preallocated tensor of shape [num_parents, num_children] which is filled with Gumbel noises
+    :returns: a pair of perturbed log-probabilities of children and Gumbel noises,
+              where both are tensors of shape [num_parents, num_children]
+    '''
+
+    assert child_log_probs.dim() == 2
+    assert parent_perturbed_log_probs.size() == child_log_probs.size()[:1]
+
+    gumbels = sample_gumbels(
+        child_log_probs.size(), generator=generator,
+        device=child_log_probs.device, dtype=child_log_probs.dtype, out=gumbels_out)
+    perturbed_log_probs = child_log_probs + gumbels
+
+    max_child_perturbed_log_probs, _ = perturbed_log_probs.max(dim=-1, keepdim=True)
+
+    T = parent_perturbed_log_probs.unsqueeze(-1)
+    Z = max_child_perturbed_log_probs
+
+    u = T - perturbed_log_probs + torch.log1p(- torch.exp(perturbed_log_probs - Z))
+    perturbed_log_probs = T - F.relu(u) - torch.log1p(torch.exp(-u.abs()))
+
+    # When all children of a parent have -inf, the above computation produces nan values.
+    perturbed_log_probs.masked_fill_(child_log_probs == float('-inf'), float('-inf'))
+
+    return perturbed_log_probs, gumbels
+
+
+def stochastic_beam_topk(parent_perturbed_log_probs, child_log_probs, k, generator=None, gumbels_out=None):
+    '''
+    Select the top-k children over all parents by perturbed log-probabilities for stochastic beam search.
+
+    :param parent_perturbed_log_probs: a tensor of shape [num_parents]
+    :param child_log_probs: a tensor of shape [num_parents, num_children]
+    :param k: the beam size
+    :returns: a triple of the perturbed log-probabilities, the parent indices and the child indices of
+              the selected children, where all are tensors of shape [min(k, num_parents * num_children)]
+    '''
+
+    perturbed_log_probs, _ = get_batched_perturbed_log_probs(
+        parent_perturbed_log_probs, child_log_probs, generator=generator, gumbels_out=gumbels_out)
+
+    num_children = child_log_probs.size(-1)
+    top_perturbed_log_probs, flat_indices = perturbed_log_probs.view(-1).topk(min(k, perturbed_log_probs.numel()))
+    parent_indices = torch.div(flat_indices, num_children, rounding_mode='floor')
+    child_indices = flat_indices % num_children
+
+    return top_perturbed_log_probs, parent_indices, child_indices